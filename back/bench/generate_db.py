@@ -0,0 +1,100 @@
+# Builds a synthetic menu.db for benchmarks.
+# Usage: python back/bench/generate_db.py --size medium --dir /tmp/bench/medium
+#        python back/bench/generate_db.py --items 300 --orders 50000 --dir /tmp/bench/custom
+import argparse
+import datetime
+import logging
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+SIZES = {
+    'small': {'items': 100, 'orders': 1_000},
+    'medium': {'items': 1_000, 'orders': 100_000},
+    'large': {'items': 5_000, 'orders': 1_000_000}
+}
+CATEGORIES = 20
+DAYS = 180
+BATCH = 10_000
+PAYMENT_METHODS = ['cash', 'click', 'payme']
+STATUSES = ['new', 'in_progress', 'closed', 'closed', 'closed', 'closed']
+
+def generate(directory, items, orders, seed):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'menu.db')
+    main.DB_NAME = path
+    for name in (path, main.archive_db_name()):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+    main.migrate_db()
+    main.close_db_pool()
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('ATTACH DATABASE ? AS archive', (main.archive_db_name(),))
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO categories (value, name) VALUES (?, ?)',
+                     [(f'bench{n}', f'Категория {n}') for n in range(CATEGORIES)])
+    conn.executemany('INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)',
+                     [(f'bench{rng.randrange(CATEGORIES)}', f'Блюдо {n}', f'Описание блюда {n}',
+                       rng.randrange(100, 2000, 10), 'src/images/default.jpg') for n in range(items)])
+    menu = conn.execute('SELECT id, name, price FROM items').fetchall()
+    next_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM orders').fetchone()[0]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    written = 0
+    while written < orders:
+        order_rows = []
+        line_rows = []
+        for order_id in range(next_id + written, next_id + min(written + BATCH, orders)):
+            lines = rng.sample(menu, rng.randint(1, 5))
+            quantities = [rng.randint(1, 3) for _ in lines]
+            total = sum(price * quantity for (_, _, price), quantity in zip(lines, quantities))
+            created_at = now - datetime.timedelta(seconds=rng.randrange(DAYS * 86400))
+            payment_method = rng.choice(PAYMENT_METHODS)
+            order_rows.append((order_id, f'Гость {order_id}', '+998 (90) 000-00-00', total, rng.choice(STATUSES),
+                               created_at.strftime('%Y-%m-%d %H:%M:%S'), payment_method,
+                               'Оплачен' if payment_method != 'cash' else 'Не оплачен',
+                               f'Столик {rng.randint(1, 60)}'))
+            line_rows.extend((order_id, item_id, name, price, quantity)
+                             for (item_id, name, price), quantity in zip(lines, quantities))
+        conn.executemany('''
+            INSERT INTO orders (id, user_name, phone, items, total, status, created_at, payment_method,
+                                payment_status, table_number)
+            VALUES (?, ?, ?, '', ?, ?, ?, ?, ?, ?)
+        ''', order_rows)
+        conn.executemany('INSERT INTO order_items (order_id, item_id, name, unit_price, quantity) VALUES (?, ?, ?, ?, ?)',
+                         line_rows)
+        written += len(order_rows)
+        print(f'\r{written}/{orders} orders', end='', flush=True)
+    print()
+    main.rebuild_stats(conn)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    return path
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', choices=SIZES, default='small')
+    parser.add_argument('--items', type=int, help='overrides the size preset')
+    parser.add_argument('--orders', type=int, help='overrides the size preset')
+    parser.add_argument('--dir', required=True, help='directory for menu.db')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    preset = SIZES[args.size]
+    items = args.items if args.items is not None else preset['items']
+    orders = args.orders if args.orders is not None else preset['orders']
+    started = time.perf_counter()
+    path = generate(args.dir, items, orders, args.seed)
+    print(f'{path}: {items} items, {orders} orders in {time.perf_counter() - started:.1f}s')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,72 @@
+# Compares per-request order commits with the group-commit writer.
+# Usage: python back/bench/ingest.py [--threads 32] [--orders 50]
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+ORDER = {
+    'user_name': 'Bench',
+    'phone': '+998 (90) 000-00-00',
+    'cart': [{'id': 1, 'quantity': 2}, {'id': 4, 'quantity': 1}],
+    'payment_method': 'cash',
+    'lots': main.make_table_token('1')
+}
+
+def run(mode, threads, orders_per_thread, db_path):
+    main.close_db_pool()
+    main.DB_NAME = db_path
+    main.ORDER_INGEST_MODE = mode
+    main.migrate_db()
+    latencies = []
+    errors = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        client = main.app.test_client()
+        local = []
+        barrier.wait()
+        for _ in range(orders_per_thread):
+            started = time.perf_counter()
+            response = client.post('/api/create-order', json=ORDER)
+            local.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        latencies.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'{mode:>6}: {len(latencies) / elapsed:8.1f} orders/s  '
+          f'p50 {quantiles[49] * 1000:6.1f} ms  p95 {quantiles[94] * 1000:6.1f} ms  '
+          f'p99 {quantiles[98] * 1000:6.1f} ms  errors {len(errors)}')
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--orders', type=int, default=50, help='orders per thread')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    # Every simulated guest is the same client ordering for the same table; measure the writer, not the limiter.
+    main.guest_ip_limiter.rate = main.table_order_limiter.rate = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('direct', 'batch'):
+            run(mode, args.threads, args.orders, os.path.join(tmp, f'{mode}.db'))
+    main.close_db_pool()
+
+if __name__ == '__main__':
+    bench()
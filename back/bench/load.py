@@ -0,0 +1,282 @@
+# Drives the backend over HTTP and reports throughput and p50/p95/p99 latency per endpoint.
+# Usage: python back/bench/load.py --dir /tmp/bench/medium --out results.json [--compare old.json]
+#        python back/bench/load.py --url http://127.0.0.1:3000 --scenarios menu,mixed
+# Without --url a server is started in --dir, so it serves that directory's menu.db: "flask run", or serve.py
+# when --workers is given.
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+SERVE_PATH = os.path.join(os.path.dirname(MAIN_PATH), 'serve.py')
+SCENARIOS = ['menu', 'create-order', 'orders', 'login', 'transitions', 'mixed']
+TABLES = 60
+MIXED_WEIGHTS = {'menu': 50, 'create-order': 20, 'orders': 15, 'transitions': 10, 'login': 5}
+
+class Client:
+    def __init__(self, base, token, item_ids, rng, table_tokens=()):
+        url = urllib.parse.urlsplit(base)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+        self.token = token
+        self.item_ids = item_ids
+        self.table_tokens = table_tokens
+        self.rng = rng
+        self.menu_etag = None
+
+    def request(self, method, path, body=None, headers=None, form=None):
+        headers = dict(headers or {})
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                return response.status, response.headers, data
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close()
+                if attempt:
+                    raise
+
+    def admin(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def menu(self, record):
+        # Half the guests already have the menu cached and revalidate it.
+        headers = {}
+        if self.menu_etag and self.rng.random() < 0.5:
+            headers['If-None-Match'] = self.menu_etag
+        status, headers, _ = record('GET /api/menu', self.request, 'GET', '/api/menu', headers=headers)
+        self.menu_etag = headers.get('ETag') or self.menu_etag
+
+    def create_order(self, record):
+        cart = [{'id': item_id, 'quantity': self.rng.randint(1, 3)}
+                for item_id in self.rng.sample(self.item_ids, min(len(self.item_ids), self.rng.randint(1, 4)))]
+        status, _, data = record('POST /api/create-order', self.request, 'POST', '/api/create-order', body={
+            'user_name': 'Bench', 'phone': '+998 (90) 000-00-00', 'cart': cart,
+            'payment_method': self.rng.choice(['cash', 'click']), 'lots': self.rng.choice(self.table_tokens)
+        })
+        return json.loads(data).get('order_id') if status == 200 else None
+
+    def orders(self, record):
+        query = self.rng.choice(['limit=50', 'limit=50&status=new', 'limit=50&status=closed'])
+        record('GET /api/orders', self.request, 'GET', f'/api/orders?{query}', headers=self.admin())
+
+    def login(self, record):
+        record('POST /login', self.request, 'POST', '/login', form={'username': '1', 'password': '1'})
+
+    def transitions(self, record):
+        order_id = self.create_order(record)
+        if order_id is None:
+            return
+        record('POST /api/take-order', self.request, 'POST', f'/api/take-order/{order_id}', headers=self.admin())
+        record('POST /api/update-payment-status', self.request, 'POST', f'/api/update-payment-status/{order_id}',
+               body={'payment_status': 'Оплачен'}, headers=self.admin())
+        record('POST /api/close-order', self.request, 'POST', f'/api/close-order/{order_id}', headers=self.admin())
+
+def run_scenario(name, base, token, item_ids, table_tokens, concurrency, duration, seed):
+    samples = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    actions = {
+        'menu': Client.menu, 'create-order': Client.create_order, 'orders': Client.orders,
+        'login': Client.login, 'transitions': Client.transitions
+    }
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(base, token, item_ids, rng, table_tokens)
+        local = {}
+
+        def record(endpoint, call, *args, **kwargs):
+            started = time.perf_counter()
+            status, headers, data = call(*args, **kwargs)
+            local.setdefault(endpoint, []).append((time.perf_counter() - started, status))
+            return status, headers, data
+
+        while time.monotonic() < deadline:
+            if name == 'mixed':
+                action = rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+            else:
+                action = name
+            actions[action](client, record)
+        with lock:
+            for endpoint, values in local.items():
+                samples.setdefault(endpoint, []).extend(values)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    endpoints = {}
+    for endpoint, values in sorted(samples.items()):
+        latencies = sorted(latency for latency, _ in values)
+        statuses = {}
+        for _, status in values:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'throughput': len(values) / elapsed,
+            'errors': sum(count for status, count in statuses.items() if int(status) >= 500),
+            'statuses': statuses,
+            'mean_ms': statistics.fmean(latencies) * 1000,
+            'p50_ms': quantiles[49] * 1000,
+            'p95_ms': quantiles[94] * 1000,
+            'p99_ms': quantiles[98] * 1000
+        }
+    total = sum(endpoint['requests'] for endpoint in endpoints.values())
+    return {'seconds': elapsed, 'requests': total, 'throughput': total / elapsed, 'endpoints': endpoints}
+
+def start_server(directory, port, env, workers=None):
+    if workers:
+        command = [sys.executable, SERVE_PATH, '--port', str(port), '--workers', str(workers)]
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', MAIN_PATH, 'run', '--port', str(port),
+                   '--with-threads', '--no-reload', '--no-debugger']
+    process = subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/menu')
+            conn.getresponse().read()
+            return process, base
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+def describe_db(directory):
+    path = os.path.join(directory, 'menu.db')
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    info = {
+        'path': path,
+        'items': conn.execute('SELECT COUNT(*) FROM items').fetchone()[0],
+        'orders': conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+    }
+    conn.close()
+    return info
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(MAIN_PATH),
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    for scenario, result in results['scenarios'].items():
+        print(f'\n{scenario}: {result["throughput"]:.1f} req/s over {result["seconds"]:.1f}s')
+        for endpoint, stats in result['endpoints'].items():
+            line = (f'  {endpoint:<34} {stats["throughput"]:8.1f} req/s  p50 {stats["p50_ms"]:7.1f}  '
+                    f'p95 {stats["p95_ms"]:7.1f}  p99 {stats["p99_ms"]:7.1f} ms  5xx {stats["errors"]}')
+            old = (baseline or {}).get('scenarios', {}).get(scenario, {}).get('endpoints', {}).get(endpoint)
+            if old:
+                line += (f'  | throughput {change(old["throughput"], stats["throughput"])}'
+                         f'  p95 {change(old["p95_ms"], stats["p95_ms"])}')
+            print(line)
+
+def change(old, new):
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='directory with menu.db (see generate_db.py); the server runs there')
+    parser.add_argument('--url', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--port', type=int, default=3100)
+    parser.add_argument('--workers', type=int, help='run the server with serve.py and this many worker processes')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to diff against')
+    args = parser.parse_args()
+    if not args.url and not args.dir:
+        parser.error('either --dir or --url is required')
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'unknown scenario {scenario}')
+
+    process = None
+    if args.url:
+        base = args.url
+    else:
+        env = dict(os.environ)
+        # Every simulated guest shares 127.0.0.1, so the per-IP and per-table limits are off unless set.
+        env.setdefault('GUEST_IP_RATE', '0')
+        env.setdefault('TABLE_ORDER_RATE', '0')
+        process, base = start_server(args.dir, args.port, env, args.workers)
+    try:
+        client = Client(base, None, [], random.Random(args.seed))
+        status, _, data = client.request('POST', '/login', form={'username': '1', 'password': '1'})
+        token = json.loads(data)['token']
+        status, _, data = client.request('GET', '/api/menu')
+        item_ids = [item['id'] for category in json.loads(data)['categories'].values() for item in category['items']]
+        # Orders must carry a signed table token, as a guest who scanned the table's QR code would.
+        status, _, data = client.request('POST', '/api/generate-table-links', body={'from': 1, 'to': TABLES},
+                                         headers={'Authorization': f'Bearer {token}'})
+        table_tokens = [urllib.parse.parse_qs(urllib.parse.urlsplit(link['link']).query)['lots'][0]
+                        for link in json.loads(data)['links']]
+        results = {
+            'meta': {
+                'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'db': describe_db(args.dir) if args.dir else None,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'seed': args.seed,
+                'workers': args.workers,
+                'ingest_mode': os.environ.get('ORDER_INGEST_MODE', 'direct')
+            },
+            'scenarios': {}
+        }
+        for scenario in scenarios:
+            results['scenarios'][scenario] = run_scenario(scenario, base, token, item_ids, table_tokens,
+                                                          args.concurrency, args.duration, args.seed)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f'\nResults written to {args.out}')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,105 @@
+# Measures /api/menu latency before and during a burst of /login requests.
+# Usage: python back/bench/login_storm.py [--storm 64] [--seconds 5] [--inline]
+import argparse
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def request(url, data=None):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=30) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - started, status
+
+def measure_menu(base, seconds):
+    # Only successful responses count towards latency; anything else is reported as a failure.
+    latencies = []
+    failures = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        latency, status = request(base + '/api/menu')
+        if status == 200:
+            latencies.append(latency)
+        else:
+            failures += 1
+    return latencies, failures
+
+def report(label, measured):
+    latencies, failures = measured
+    if len(latencies) < 2:
+        print(f'{label:>14}: {len(latencies):6d} requests  failed {failures}')
+        return
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'{label:>14}: {len(latencies):6d} requests  p50 {quantiles[49] * 1000:6.1f} ms  '
+          f'p95 {quantiles[94] * 1000:6.1f} ms  p99 {quantiles[98] * 1000:6.1f} ms  failed {failures}')
+
+def storm(base, clients, seconds, results):
+    # Runs in its own process so the load generator doesn't compete with the server for the GIL.
+    form = urllib.parse.urlencode({'username': '1', 'password': '1'}).encode()
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            latency, status = request(base + '/login', form)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(statuses)
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storm', type=int, default=64, help='concurrent login clients')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--inline', action='store_true',
+                        help='run bcrypt on the request thread, as before the login pool, for comparison')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    # The menu probe alone runs far above the per-IP guest budget; this measures latency, not admission control.
+    main.guest_ip_limiter.rate = main.table_order_limiter.rate = 0
+    if args.inline:
+        main.check_password = lambda password, hashed: main.bcrypt.checkpw(password.encode('utf-8'), hashed)
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_NAME = os.path.join(tmp, 'menu.db')
+        main.migrate_db()
+        server = make_server('127.0.0.1', 0, main.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_port}'
+
+        report('idle', measure_menu(base, args.seconds))
+
+        results = multiprocessing.Queue()
+        attacker = multiprocessing.Process(target=storm, args=(base, args.storm, args.seconds + 1, results))
+        attacker.start()
+        time.sleep(0.5)
+        report('login storm', measure_menu(base, args.seconds))
+        print('login responses:', dict(sorted(results.get().items())))
+        attacker.join()
+        server.shutdown()
+        main.close_db_pool()
+
+if __name__ == '__main__':
+    bench()
@@ -1,11 +1,41 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response, g
 from flask_cors import CORS
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+from functools import wraps
 import jwt
 import bcrypt
 import sqlite3
 import logging
+import hashlib
+import heapq
+import gzip
+import mimetypes
+import re
+import threading
+import base64
+import datetime
+import bisect
+import csv
+import io
+import itertools
+import queue
+import time
 import json
+import math
 import os
+import zipfile
+import click
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 app = Flask(__name__, static_folder='static')
 CORS(app, supports_credentials=True)
@@ -13,32 +43,563 @@ SECRET_KEY = 'your-secret-key'
 
 logging.basicConfig(level=logging.DEBUG)
 
-users = [
-    {
+users = {
+    '1': {
         'username': '1',
         'password': bcrypt.hashpw('1'.encode('utf-8'), bcrypt.gensalt())
     }
-]
+}
 
 DB_NAME = 'menu.db'
+ORDERS_PAGE_SIZE = 50
+ORDERS_MAX_PAGE_SIZE = 500
+CART_MAX_QUANTITY = 999
+ORDER_FEED_TIMEOUT = 25
+ORDER_FEED_BATCH = 500
+ORDER_FEED_RETENTION = 10000
+MIGRATION_COPY_BATCH = 5000
+ORDER_EXPORT_CHUNK = 1000
+ORDER_EXPORT_FLUSH_BYTES = 64 * 1024
+ORDER_EXPORT_CSV_COLUMNS = ['order_id', 'created_at', 'table_number', 'user_name', 'phone', 'status', 'payment_method',
+                            'payment_status', 'payment_comment', 'order_total', 'item_id', 'item_name', 'unit_price',
+                            'quantity']
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 10
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE_SIZE = 256
+# Closed orders older than this move to the archive database; 0 turns the background job off.
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDER_ARCHIVE_AFTER_DAYS', 90))
+ORDER_ARCHIVE_BATCH = 500
+ORDER_ARCHIVE_INTERVAL = 3600
+ORDER_ARCHIVE_CHECK_INTERVAL = 60
+ORDER_COLUMNS = ('id, user_name, phone, items, total, status, created_at, payment_method, payment_status, '
+                 'table_number, payment_comment')
+ORDER_ITEM_COLUMNS = 'id, order_id, item_id, name, unit_price, quantity'
+CACHE_WATCH_INTERVAL = float(os.environ.get('CACHE_WATCH_INTERVAL_MS', 200)) / 1000
+# 'direct' commits every order in its own transaction, 'batch' hands orders to a group-commit writer thread.
+ORDER_INGEST_MODE = os.environ.get('ORDER_INGEST_MODE', 'direct')
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', 64))
+ORDER_BATCH_WINDOW = float(os.environ.get('ORDER_BATCH_WINDOW_MS', 2)) / 1000
+ORDER_INGEST_TIMEOUT = 10
+TOKEN_CACHE_SIZE = 1024
+TABLE_TOKEN_CACHE_SIZE = 1024
+# Replays of a create-order request within this window are answered from memory; the unique index on
+# orders.idempotency_key catches any that arrive later or at another worker process.
+IDEMPOTENCY_CACHE_SIZE = 4096
+IDEMPOTENCY_CACHE_TTL = 600
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+TABLE_LINK_BASE = 'file:///C:/Users/slava/Desktop/Defency/Some-site/redirect.html'
+TABLE_LINKS_MAX = 500
+ORDER_BULK_MAX = 500
+MENU_BATCH_MAX = 1000
+DEFAULT_DISH_IMAGE = 'src/images/default.jpg'
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_TERMS = 8
+LOGIN_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+LOGIN_MAX_PENDING = 8
+LOGIN_TIMEOUT = 10
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 300
+# Admission control for the unauthenticated guest endpoints, per worker process. Rates are requests per
+# second refilling a bucket of BURST requests; a rate of 0 turns that limit off. Guests at one restaurant
+# usually share an IP behind the Wi-Fi router, so the per-IP budget is the generous one. Orders are also
+# limited per signed table token.
+GUEST_IP_RATE = float(os.environ.get('GUEST_IP_RATE', 20))
+GUEST_IP_BURST = int(os.environ.get('GUEST_IP_BURST', 100))
+TABLE_ORDER_RATE = float(os.environ.get('TABLE_ORDER_RATE', 0.2))
+TABLE_ORDER_BURST = int(os.environ.get('TABLE_ORDER_BURST', 5))
+RATE_LIMIT_MAX_KEYS = 10000
+# Guest requests in progress, and orders waiting for the write path; anything beyond is shed with 503.
+GUEST_MAX_PENDING = int(os.environ.get('GUEST_MAX_PENDING', 128))
+ORDER_MAX_PENDING = int(os.environ.get('ORDER_MAX_PENDING', 32))
+FRONTEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSET_BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build')
+ASSET_PAGES = ['index.html', 'cart.html', 'admin.html', 'login.html', 'redirect.html', 'reviews.html']
+ASSET_DIR = 'src'
+ASSET_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+ASSET_MAX_AGE = 365 * 24 * 3600
+MENU_PAGE = 'index.html'
+MENU_DATA_PLACEHOLDER = b'<script type="application/json" id="menu-data"></script>'
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+IMAGE_URL_PREFIX = '/uploads/'
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_CHUNK_SIZE = 64 * 1024
+# Thumbnail (cart), card, and card on 2x screens.
+IMAGE_VARIANT_WIDTHS = (160, 480, 960)
+IMAGE_VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})
+}
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, le=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((label_values, (list(counts), total, count))
+                            for label_values, (counts, total, count) in self.series.items())
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, label_values, bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, label_values)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, label_values)} {count}')
+        return lines
+
+http_requests_total = Counter('http_requests_total', 'HTTP requests by route and status.',
+                              ('method', 'endpoint', 'status'))
+http_request_seconds = Histogram('http_request_duration_seconds', 'Time to build the response.',
+                                 labels=('method', 'endpoint'))
+http_request_db_statements = Histogram('http_request_db_statements', 'SQLite statements executed per request.',
+                                       METRICS_COUNT_BUCKETS, ('endpoint',))
+http_request_db_seconds = Histogram('http_request_db_seconds', 'Time spent inside SQLite per request.',
+                                    labels=('endpoint',))
+db_statement_seconds = Histogram('db_statement_duration_seconds', 'Duration of single SQLite statements.')
+db_pool_wait_seconds = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection.')
+db_lock_wait_seconds = Histogram('db_lock_wait_seconds', 'Time spent waiting for the SQLite write lock.')
+http_requests_rejected_total = Counter('http_requests_rejected_total', 'Guest requests turned away by admission control.',
+                                       ('endpoint', 'reason'))
+METRICS = [http_requests_total, http_request_seconds, http_request_db_statements, http_request_db_seconds,
+           db_statement_seconds, db_pool_wait_seconds, db_lock_wait_seconds, http_requests_rejected_total]
+
+class DbStats(threading.local):
+    # Per-thread SQLite counters; before_request resets them, after_request reports them.
+    statements = 0
+    seconds = 0.0
+
+db_stats = DbStats()
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_statement_seconds.observe(elapsed)
+            db_stats.statements += 1
+            db_stats.seconds += elapsed
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_statement_seconds.observe(elapsed)
+            db_stats.statements += 1
+            db_stats.seconds += elapsed
+
+    # Rows after the first are produced while fetching, so that time counts as SQLite time too.
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            db_stats.seconds += time.perf_counter() - started
+
+    def fetchmany(self, size=1):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(size)
+        finally:
+            db_stats.seconds += time.perf_counter() - started
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            db_stats.seconds += time.perf_counter() - started
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            db_stats.seconds += time.perf_counter() - started
+
+db_pool = queue.LifoQueue()
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+def archive_db_name():
+    return os.environ.get('ARCHIVE_DB_NAME') or f'{os.path.splitext(DB_NAME)[0]}-archive.db'
+
+def open_db_connection():
+    # Autocommit mode: writes are grouped explicitly with transaction().
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE,
+                           factory=TimedConnection)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    # Archived orders live in their own file so the hot database stays small; see archive_orders().
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_db_name(),))
+    conn.execute('PRAGMA archive.journal_mode = WAL')
+    conn.execute('PRAGMA archive.synchronous = NORMAL')
     return conn
 
+@contextmanager
+def db_connection():
+    started = time.perf_counter()
+    acquired = db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+    db_pool_wait_seconds.observe(time.perf_counter() - started)
+    if not acquired:
+        raise sqlite3.OperationalError('database connection pool exhausted')
+    try:
+        try:
+            conn = db_pool.get_nowait()
+        except queue.Empty:
+            conn = open_db_connection()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            db_pool.put(conn)
+    finally:
+        db_pool_slots.release()
+
+@contextmanager
+def transaction():
+    with db_connection() as conn:
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        db_lock_wait_seconds.observe(time.perf_counter() - started)
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+def close_db_pool():
+    while True:
+        try:
+            db_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+menu_cache = {'version': 0, 'built_version': -1, 'body': None, 'etag': None}
+menu_cache_lock = threading.Lock()
+
+def invalidate_menu():
+    with menu_cache_lock:
+        menu_cache['version'] += 1
+
+def build_menu():
+    with db_connection() as conn:
+        categories = conn.execute('SELECT value, name FROM categories').fetchall()
+        items = conn.execute('SELECT * FROM items').fetchall()
+        images = conn.execute("SELECT hash, status, widths FROM images WHERE status IN ('pending', 'ready')").fetchall()
+    if any(image['status'] == 'pending' for image in images):
+        ensure_image_worker()
+    variants = {image['hash']: image['widths'] for image in images if image['status'] == 'ready'}
+    menu = {}
+    for cat in categories:
+        cat_value = cat['value']
+        menu[cat_value] = {'name': cat['name'], 'items': []}
+    for item in items:
+        cat = item['category']
+        if cat in menu:
+            menu[cat]['items'].append({
+                'id': item['id'],
+                'name': item['name'],
+                'description': item['description'],
+                'price': item['price'],
+                'image': item['image'],
+                'srcset': image_srcset(item['image'], variants)
+            })
+    return menu
+
+def get_menu_snapshot():
+    # Returns (version, body, etag); the body is rebuilt only after invalidate_menu().
+    with menu_cache_lock:
+        version = menu_cache['version']
+        if menu_cache['built_version'] == version:
+            return version, menu_cache['body'], menu_cache['etag']
+    body = app.json.dumps({'categories': build_menu()}).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    with menu_cache_lock:
+        # Don't publish a snapshot that was read while an invalidation happened.
+        if menu_cache['version'] == version:
+            menu_cache['built_version'] = version
+            menu_cache['body'] = body
+            menu_cache['etag'] = etag
+    return version, body, etag
+
+price_index = {}
+price_index_state = {'loaded': False}
+price_index_lock = threading.Lock()
+
+def load_price_index():
+    # Called with price_index_lock held, so a concurrent dish update can't be overwritten by stale rows.
+    with db_connection() as conn:
+        rows = conn.execute('SELECT id, name, price, category FROM items').fetchall()
+    price_index.clear()
+    for row in rows:
+        price_index[row['id']] = (row['name'], row['price'], row['category'])
+    price_index_state['loaded'] = True
+
+def reset_price_index():
+    with price_index_lock:
+        price_index.clear()
+        price_index_state['loaded'] = False
+
+def index_item_price(item_id, name, price, category):
+    with price_index_lock:
+        if price_index_state['loaded']:
+            price_index[item_id] = (name, price, category)
+
+def unindex_item_prices(item_id=None, category=None):
+    with price_index_lock:
+        if item_id is not None:
+            price_index.pop(item_id, None)
+        if category is not None:
+            for key in [key for key, entry in price_index.items() if entry[2] == category]:
+                del price_index[key]
+
+def lookup_prices(item_ids):
+    with price_index_lock:
+        if not price_index_state['loaded']:
+            load_price_index()
+        found = {item_id: price_index[item_id] for item_id in item_ids if item_id in price_index}
+    missing = [item_id for item_id in item_ids if item_id not in found]
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        with db_connection() as conn:
+            rows = conn.execute(f'SELECT id, name, price, category FROM items WHERE id IN ({placeholders})',
+                                missing).fetchall()
+        for row in rows:
+            found[row['id']] = (row['name'], row['price'], row['category'])
+            index_item_price(row['id'], row['name'], row['price'], row['category'])
+    return found
+
+def quote_cart(cart):
+    # Prices the cart from the menu; raises ValueError/KeyError/TypeError on a malformed cart.
+    if not isinstance(cart, list):
+        raise ValueError('cart must be a list')
+    quantities = {}
+    for item in cart:
+        item_id = int(item['id'])
+        quantity = int(item['quantity'])
+        if quantity <= 0:
+            raise ValueError('quantity must be positive')
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+        # Python ints never overflow, but SQLite's do; keep totals far from its 64-bit limit.
+        if quantities[item_id] > CART_MAX_QUANTITY:
+            raise ValueError('quantity is too large')
+    prices = lookup_prices(list(quantities))
+    lines = []
+    missing = []
+    for item_id, quantity in quantities.items():
+        if item_id not in prices:
+            missing.append(item_id)
+            continue
+        name, price, _category = prices[item_id]
+        lines.append({'id': item_id, 'name': name, 'price': price, 'quantity': quantity})
+    total = sum(line['price'] * line['quantity'] for line in lines)
+    return lines, total, missing
+
+order_feed = threading.Condition()
+
+def record_order_change(conn, order_id):
+    cursor = conn.execute('INSERT INTO order_changes (order_id) VALUES (?)', (order_id,))
+    seq = cursor.lastrowid
+    if seq % 1000 == 0:
+        conn.execute('DELETE FROM order_changes WHERE seq <= ?', (seq - ORDER_FEED_RETENTION,))
+
+def publish_order_changes():
+    # Wakes long-polling /api/orders/changes requests in this process.
+    with order_feed:
+        order_feed.notify_all()
+
+def get_feed_cursor(conn):
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM order_changes').fetchone()[0]
+
+cache_watcher_state = {'thread': None}
+cache_watcher_lock = threading.Lock()
+
+def watch_caches():
+    # Keeps this process's menu cache, price index and order feed in step with commits made by other
+    # worker processes. PRAGMA data_version only changes after another connection commits and is read
+    # from shared memory, so polling it is cheap; the version tables are only read when it moves.
+    # Token caches need nothing: they only remember signature checks against fixed secrets.
+    conn = open_db_connection()
+    data_version = menu_version = feed_cursor = None
+    while True:
+        try:
+            current = conn.execute('PRAGMA data_version').fetchone()[0]
+            if current != data_version:
+                data_version = current
+                version = conn.execute("SELECT version FROM cache_versions WHERE name = 'menu'").fetchone()[0]
+                if menu_version is not None and version != menu_version:
+                    invalidate_menu()
+                    reset_price_index()
+                menu_version = version
+                cursor = get_feed_cursor(conn)
+                if feed_cursor is not None and cursor != feed_cursor:
+                    publish_order_changes()
+                feed_cursor = cursor
+        except sqlite3.Error as e:
+            app.logger.error(f"Cache watcher failed: {e}")
+        time.sleep(CACHE_WATCH_INTERVAL)
+
+def start_cache_watcher():
+    with cache_watcher_lock:
+        if cache_watcher_state['thread'] is None:
+            cache_watcher_state['thread'] = threading.Thread(target=watch_caches, name='cache-watcher', daemon=True)
+            cache_watcher_state['thread'].start()
+
+class LruCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+class RateLimiter:
+    # Token buckets keyed by client; only the least recently seen max_keys buckets are kept, and a forgotten
+    # client simply starts again with a full bucket.
+    def __init__(self, rate, burst, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        # Returns 0 if the request may proceed, otherwise the seconds until the bucket has a token again.
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return wait
+
+token_cache = LruCache(TOKEN_CACHE_SIZE)
+table_token_cache = LruCache(TABLE_TOKEN_CACHE_SIZE)
+idempotency_cache = LruCache(IDEMPOTENCY_CACHE_SIZE)
+
+def cached_token(token):
+    # Returns the username of an already verified, unexpired token, or None.
+    entry = token_cache.get(token)
+    if entry is None:
+        return None
+    username, expires_at = entry
+    if expires_at is not None and expires_at <= time.time():
+        token_cache.pop(token)
+        return None
+    return username
+
+def cache_token(token, username, expires_at):
+    token_cache.put(token, (username, expires_at))
+
 def verify_token(token):
     if not token:
         app.logger.debug('No token provided')
         return None, {'error': 'Токен отсутствует'}, 401
+    username = cached_token(token)
+    if username is not None and username in users:
+        return username, None, None
     try:
         data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
         username = data['username']
-        user = next((u for u in users if u['username'] == username), None)
-        if not user:
+        if username not in users:
             app.logger.debug('User from token not found')
             return None, {'error': 'Пользователь не найден'}, 401
-        app.logger.debug('Token valid')
+        cache_token(token, username, data.get('exp'))
         return username, None, None
     except jwt.ExpiredSignatureError:
         app.logger.debug('Token expired')
@@ -47,27 +608,391 @@ def verify_token(token):
         app.logger.debug('Invalid token')
         return None, {'error': 'Неверный токен'}, 401
 
-def init_db():
-    with get_db_connection() as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                value TEXT NOT NULL UNIQUE,
-                name TEXT NOT NULL
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                name TEXT NOT NULL,
-                description TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                image TEXT NOT NULL
-            )
-        ''')
+login_pool = ThreadPoolExecutor(max_workers=LOGIN_WORKERS, thread_name_prefix='login')
+# Bounds running plus queued password checks; anything beyond that is shed instead of queued.
+login_slots = threading.BoundedSemaphore(LOGIN_MAX_PENDING)
+login_failures = {}
+login_failures_lock = threading.Lock()
+
+def login_retry_after(username):
+    # Seconds until the user may try again, or 0 if not throttled.
+    with login_failures_lock:
+        entry = login_failures.get(username)
+        if not entry:
+            return 0
+        count, window_start = entry
+        remaining = window_start + LOGIN_FAILURE_WINDOW - time.time()
+        if remaining <= 0:
+            del login_failures[username]
+            return 0
+        return int(remaining) + 1 if count >= LOGIN_MAX_FAILURES else 0
+
+def record_login_result(username, success):
+    with login_failures_lock:
+        if success:
+            login_failures.pop(username, None)
+            return
+        count, window_start = login_failures.get(username, (0, time.time()))
+        login_failures[username] = (count + 1, window_start)
+
+def check_password(password, hashed):
+    if not login_slots.acquire(blocking=False):
+        return None
+    try:
+        future = login_pool.submit(bcrypt.checkpw, password.encode('utf-8'), hashed)
+    except BaseException:
+        login_slots.release()
+        raise
+    future.add_done_callback(lambda _: login_slots.release())
+    return future.result(timeout=LOGIN_TIMEOUT)
+
+guest_ip_limiter = RateLimiter(GUEST_IP_RATE, GUEST_IP_BURST)
+table_order_limiter = RateLimiter(TABLE_ORDER_RATE, TABLE_ORDER_BURST)
+guest_slots = threading.BoundedSemaphore(GUEST_MAX_PENDING)
+order_slots = threading.BoundedSemaphore(ORDER_MAX_PENDING)
+
+def reject_request(reason, status, retry_after):
+    http_requests_rejected_total.inc(metrics_endpoint(), reason)
+    if status == 429:
+        response = jsonify({'error': 'Слишком много запросов, попробуйте позже'})
+    else:
+        response = jsonify({'error': 'Сервер перегружен, попробуйте ещё раз'})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+def admission_control(write_slots=None):
+    # Cheap checks first: the per-IP rate limit answers 429, then a bounded number of requests in progress
+    # answers 503 before they pile up on the database. Orders are also limited per table, see create_order().
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = guest_ip_limiter.take(request.remote_addr)
+            if retry_after:
+                return reject_request('ip_rate', 429, retry_after)
+            if not guest_slots.acquire(blocking=False):
+                return reject_request('overloaded', 503, 1)
+            try:
+                if write_slots is None:
+                    return view(*args, **kwargs)
+                if not write_slots.acquire(blocking=False):
+                    return reject_request('overloaded', 503, 1)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    write_slots.release()
+            finally:
+                guest_slots.release()
+        return wrapper
+    return decorator
+
+def require_auth(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        username, error, status = verify_token(token)
+        if error:
+            return jsonify(error), status
+        g.username = username
+        return view(*args, **kwargs)
+    return wrapper
+
+def create_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_items_category ON items (category)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_payment_status_created ON orders (payment_status, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_table_created ON orders (table_number, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_item ON order_items (item_id)')
+
+def create_order_items_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL REFERENCES orders (id),
+            item_id INTEGER,
+            name TEXT NOT NULL,
+            unit_price INTEGER NOT NULL,
+            quantity INTEGER NOT NULL
+        )
+    ''')
+
+def create_archive_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.orders (
+            id INTEGER PRIMARY KEY,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            items TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at DATETIME,
+            payment_method TEXT,
+            payment_status TEXT,
+            table_number TEXT,
+            payment_comment TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.order_items (
+            id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            item_id INTEGER,
+            name TEXT NOT NULL,
+            unit_price INTEGER NOT NULL,
+            quantity INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.archive_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_created ON orders (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_status_created ON orders (status, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_order_items_order ON order_items (order_id)')
+
+def create_images_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            hash TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            widths TEXT NOT NULL DEFAULT '',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def create_cache_versions(conn):
+    # Bumped by triggers on every menu change, whichever process or tool made it; see watch_caches().
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('menu')")
+    for table in ('categories', 'items', 'images'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_menu_version AFTER {event} ON {table} BEGIN
+                    UPDATE cache_versions SET version = version + 1 WHERE name = 'menu';
+                END
+            ''')
+
+def fts_normalize(column):
+    # unicode61 folds Cyrillic case but treats ё and е as different letters.
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+def create_search_index(conn):
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name, description)
+            VALUES (new.id, {fts_normalize('new.name')}, {fts_normalize('new.description')});
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, description ON items BEGIN
+            UPDATE items_fts SET name = {fts_normalize('new.name')}, description = {fts_normalize('new.description')}
+            WHERE rowid = new.id;
+        END
+    ''')
+
+def create_stats_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            closed_orders INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_by_table (
+            day TEXT NOT NULL,
+            table_number TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            PRIMARY KEY (day, table_number)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_by_payment (
+            day TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            payment_status TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            PRIMARY KEY (day, payment_method, payment_status)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_by_dish (
+            day TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            PRIMARY KEY (day, item_id, name)
+        )
+    ''')
+
+# Each statement adds (sign = 1) or removes (sign = -1) one order's contribution to a summary table.
+STATS_UPSERTS = {
+    'sales_daily': '''
+        INSERT INTO sales_daily (day, orders, revenue)
+        SELECT date(created_at), ?, ? * total FROM orders WHERE id = ?
+        ON CONFLICT (day) DO UPDATE SET
+            orders = orders + excluded.orders, revenue = revenue + excluded.revenue
+    ''',
+    'sales_by_table': '''
+        INSERT INTO sales_by_table (day, table_number, orders, revenue)
+        SELECT date(created_at), COALESCE(table_number, ''), ?, ? * total FROM orders WHERE id = ?
+        ON CONFLICT (day, table_number) DO UPDATE SET
+            orders = orders + excluded.orders, revenue = revenue + excluded.revenue
+    ''',
+    'sales_by_payment': '''
+        INSERT INTO sales_by_payment (day, payment_method, payment_status, orders, revenue)
+        SELECT date(created_at), COALESCE(payment_method, ''), COALESCE(payment_status, ''), ?, ? * total
+        FROM orders WHERE id = ?
+        ON CONFLICT (day, payment_method, payment_status) DO UPDATE SET
+            orders = orders + excluded.orders, revenue = revenue + excluded.revenue
+    ''',
+    'sales_by_dish': '''
+        INSERT INTO sales_by_dish (day, item_id, name, quantity, revenue)
+        SELECT date(o.created_at), COALESCE(oi.item_id, 0), oi.name, ? * oi.quantity, ? * oi.unit_price * oi.quantity
+        FROM order_items oi JOIN orders o ON o.id = oi.order_id WHERE oi.order_id = ?
+        ON CONFLICT (day, item_id, name) DO UPDATE SET
+            quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue
+    '''
+}
+
+def add_order_stats(conn, order_id, sign=1, tables=STATS_UPSERTS):
+    for table in tables:
+        conn.execute(STATS_UPSERTS[table], (sign, sign, order_id))
+
+def record_order_closed_stats(conn, order_id):
+    conn.execute('''
+        UPDATE sales_daily SET closed_orders = closed_orders + 1
+        WHERE day = (SELECT date(created_at) FROM orders WHERE id = ?)
+    ''', (order_id,))
+
+ALL_ORDERS = f'(SELECT {ORDER_COLUMNS} FROM main.orders UNION ALL SELECT {ORDER_COLUMNS} FROM archive.orders)'
+ALL_ORDER_ITEMS = (f'(SELECT {ORDER_ITEM_COLUMNS} FROM main.order_items '
+                   f'UNION ALL SELECT {ORDER_ITEM_COLUMNS} FROM archive.order_items)')
+
+def rebuild_stats(conn):
+    for table in STATS_UPSERTS:
+        conn.execute(f'DELETE FROM {table}')
+    conn.execute(f'''
+        INSERT INTO sales_daily (day, orders, revenue, closed_orders)
+        SELECT date(created_at), COUNT(*), SUM(total), SUM(status = 'closed') FROM {ALL_ORDERS} GROUP BY 1
+    ''')
+    conn.execute(f'''
+        INSERT INTO sales_by_table (day, table_number, orders, revenue)
+        SELECT date(created_at), COALESCE(table_number, ''), COUNT(*), SUM(total) FROM {ALL_ORDERS} GROUP BY 1, 2
+    ''')
+    conn.execute(f'''
+        INSERT INTO sales_by_payment (day, payment_method, payment_status, orders, revenue)
+        SELECT date(created_at), COALESCE(payment_method, ''), COALESCE(payment_status, ''), COUNT(*), SUM(total)
+        FROM {ALL_ORDERS} GROUP BY 1, 2, 3
+    ''')
+    conn.execute(f'''
+        INSERT INTO sales_by_dish (day, item_id, name, quantity, revenue)
+        SELECT date(o.created_at), COALESCE(oi.item_id, 0), oi.name, SUM(oi.quantity), SUM(oi.unit_price * oi.quantity)
+        FROM {ALL_ORDER_ITEMS} oi JOIN {ALL_ORDERS} o ON o.id = oi.order_id GROUP BY 1, 2, 3
+    ''')
+
+def cart_to_order_items(order_id, cart):
+    return [(order_id, item.get('id'), item.get('name', ''), item.get('price', 0), item.get('quantity', 0))
+            for item in cart]
+
+def legacy_number(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def legacy_cart_lines(order_id, cart):
+    # Returns (lines, complete); entries that aren't objects are skipped, missing or odd fields are coerced.
+    if not isinstance(cart, list):
+        return [], False
+    lines = []
+    for item in cart:
+        if not isinstance(item, dict):
+            continue
+        lines.append((order_id, legacy_number(item.get('id'), None), str(item.get('name') or ''),
+                      legacy_number(item.get('price'), 0), legacy_number(item.get('quantity'), 0)))
+    return lines, len(lines) == len(cart)
+
+def migrate_order_items(conn):
+    # Moves one chunk of legacy orders.items JSON blobs into order_items, so a large database is converted
+    # over many short transactions; migration_state remembers the last order looked at. Returns True once
+    # every blob has been looked at. Only fully converted blobs are cleared: unreadable or partly readable ones
+    # stay in orders.items for someone to inspect.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS migration_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    row = conn.execute("SELECT value FROM migration_state WHERE key = 'order_items_after'").fetchone()
+    batch = conn.execute("SELECT id, items FROM orders WHERE id > ? AND items != '' ORDER BY id LIMIT ?",
+                         (int(row['value']) if row else 0, MIGRATION_COPY_BATCH)).fetchall()
+    lines = []
+    converted = []
+    for order in batch:
+        try:
+            cart = json.loads(order['items'])
+        except ValueError:
+            cart = None
+        order_lines, complete = legacy_cart_lines(order['id'], cart)
+        lines.extend(order_lines)
+        if complete:
+            converted.append((order['id'],))
+        else:
+            app.logger.error(f"Order {order['id']} has unreadable items, left in orders.items")
+    conn.executemany('INSERT INTO order_items (order_id, item_id, name, unit_price, quantity) VALUES (?, ?, ?, ?, ?)',
+                     lines)
+    conn.executemany("UPDATE orders SET items = '' WHERE id = ?", converted)
+    if len(batch) < MIGRATION_COPY_BATCH:
+        conn.execute("DELETE FROM migration_state WHERE key = 'order_items_after'")
+        return True
+    conn.execute("INSERT OR REPLACE INTO migration_state (key, value) VALUES ('order_items_after', ?)",
+                 (str(batch[-1]['id']),))
+    app.logger.info(f"Moved line items of orders up to #{batch[-1]['id']} into order_items.")
+    return False
+
+def table_exists(conn, name, schema='main'):
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+def rewrite_legacy_orders():
+    # The first orders table had no created_at, and SQLite can't ADD COLUMN with a CURRENT_TIMESTAMP default,
+    # so the table is rebuilt. Rows are copied in batches, each in its own transaction, to keep the WAL small
+    # and writers unblocked; an interrupted copy resumes from orders_new on the next start.
+    with db_connection() as conn:
+        if not table_exists(conn, 'orders'):
+            return
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(orders)')]
+    if 'created_at' in columns:
+        return
+    app.logger.info("Rebuilding legacy orders table...")
+    with transaction() as conn:
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
+            CREATE TABLE IF NOT EXISTS orders_new (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_name TEXT NOT NULL,
                 phone TEXT NOT NULL,
@@ -75,104 +1000,358 @@ def init_db():
                 total INTEGER NOT NULL,
                 status TEXT NOT NULL DEFAULT 'new',
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                payment_method TEXT NOT NULL,
-                payment_status TEXT NOT NULL,
-                table_number TEXT NOT NULL,
+                payment_method TEXT,
+                payment_status TEXT,
+                table_number TEXT,
                 payment_comment TEXT
             )
         ''')
-        conn.commit()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM categories')
-        if cursor.fetchone()[0] == 0:
-            categories = [
-                ('pizza', 'Пицца'),
-                ('pasta', 'Паста'),
-                ('drinks', 'Напитки'),
-                ('other', 'Другие')
-            ]
-            conn.executemany('INSERT INTO categories (value, name) VALUES (?, ?)', categories)
-            conn.commit()
-        cursor.execute('SELECT COUNT(*) FROM items')
-        if cursor.fetchone()[0] == 0:
-            items = [
-                ('pizza', 'Маргарита', 'Томатный соус, моцарелла, свежий базилик, оливковое масло.', 550, 'https://mixthatdrink.com/wp-content/uploads/2023/03/classic-margarita-cocktail-540x720.jpg'),
-                ('pizza', 'Пепперони', 'Томатный соус, моцарелла, острая колбаска пепперони.', 550, 'https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcTfdW8M3-Gps9QKZssNfNSiyn-ppKZmotyzug&s'),
-                ('pizza', 'Четыре Сыра', 'Сливочный соус, моцарелла, дорблю, пармезан, чеддер.', 550, 'https://cafebrynza.ru/goods/789.jpg'),
-                ('pasta', 'Карбонара', 'Спагетти, гуанчале, яичный желток, сыр пекорино романо, черный перец.', 550, 'https://i0.wp.com/kjsfoodjournal.com/wp-content/uploads/2020/09/carbonara.png'),
-                ('pasta', 'Болоньезе', 'Тальятелле, мясной соус болоньезе (говядина, свинина, овощи), пармезан.', 550, 'src/images/photo_2025-10-18_23-47-091.jpg'),
-                ('drinks', 'Лимонад', 'Домашний, 0.5л', 550, 'src/images/photo_2025-10-18_23-47-091.jpg'),
-                ('drinks', 'Морс', 'Клюквенный, 0.5л', 550, 'src/images/photo_2025-10-18_23-47-091.jpg')
-            ]
-            conn.executemany('INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)', items)
-            conn.commit()
+    copied = 0
+    while True:
+        with transaction() as conn:
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM orders_new').fetchone()[0]
+            cursor = conn.execute('''
+                INSERT INTO orders_new (id, user_name, phone, items, total, status)
+                SELECT id, user_name, phone, items, total, status FROM orders WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, MIGRATION_COPY_BATCH))
+        if not cursor.rowcount:
+            break
+        copied += cursor.rowcount
+    with transaction() as conn:
+        conn.execute('DROP TABLE orders')
+        conn.execute('ALTER TABLE orders_new RENAME TO orders')
+    app.logger.info(f"Rebuilt orders table: {copied} orders copied.")
+
+def migrate_base_tables(conn):
+    seed = not table_exists(conn, 'categories')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            value TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        )
+    ''')
+    if seed:
+        categories = [
+            ('pizza', 'Пицца'),
+            ('pasta', 'Паста'),
+            ('drinks', 'Напитки'),
+            ('other', 'Другие')
+        ]
+        conn.executemany('INSERT INTO categories (value, name) VALUES (?, ?)', categories)
+    seed = not table_exists(conn, 'items')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            image TEXT NOT NULL
+        )
+    ''')
+    if seed:
+        items = [
+            ('pizza', 'Маргарита', 'Томатный соус, моцарелла, свежий базилик, оливковое масло.', 550, 'https://mixthatdrink.com/wp-content/uploads/2023/03/classic-margarita-cocktail-540x720.jpg'),
+            ('pizza', 'Пепперони', 'Томатный соус, моцарелла, острая колбаска пепперони.', 550, 'https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcTfdW8M3-Gps9QKZssNfNSiyn-ppKZmotyzug&s'),
+            ('pizza', 'Четыре Сыра', 'Сливочный соус, моцарелла, дорблю, пармезан, чеддер.', 550, 'https://cafebrynza.ru/goods/789.jpg'),
+            ('pasta', 'Карбонара', 'Спагетти, гуанчале, яичный желток, сыр пекорино романо, черный перец.', 550, 'https://i0.wp.com/kjsfoodjournal.com/wp-content/uploads/2020/09/carbonara.png'),
+            ('pasta', 'Болоньезе', 'Тальятелле, мясной соус болоньезе (говядина, свинина, овощи), пармезан.', 550, 'src/images/photo_2025-10-18_23-47-091.jpg'),
+            ('drinks', 'Лимонад', 'Домашний, 0.5л', 550, 'src/images/photo_2025-10-18_23-47-091.jpg'),
+            ('drinks', 'Морс', 'Клюквенный, 0.5л', 550, 'src/images/photo_2025-10-18_23-47-091.jpg')
+        ]
+        conn.executemany('INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)', items)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            items TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'new',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            payment_method TEXT NOT NULL,
+            payment_status TEXT NOT NULL,
+            table_number TEXT NOT NULL,
+            payment_comment TEXT
+        )
+    ''')
+    # Databases from before the payment fields existed.
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(orders)')]
+    for column in ('payment_method', 'payment_status', 'table_number', 'payment_comment'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE orders ADD COLUMN {column} TEXT')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL
+        )
+    ''')
+
+def migrate_order_items_table(conn):
+    create_order_items_table(conn)
+    return migrate_order_items(conn)
+
+def migrate_stats_tables(conn):
+    if not table_exists(conn, 'sales_daily'):
+        app.logger.info("Creating sales summary tables...")
+        create_stats_tables(conn)
+        rebuild_stats(conn)
+
+def migrate_idempotency_keys(conn):
+    conn.execute('ALTER TABLE orders ADD COLUMN idempotency_key TEXT')
+    conn.execute('''
+        CREATE UNIQUE INDEX idx_orders_idempotency_key ON orders (idempotency_key)
+        WHERE idempotency_key IS NOT NULL
+    ''')
+
+def migrate_search_index(conn):
+    if not table_exists(conn, 'items_fts'):
+        app.logger.info("Creating menu search index...")
+        create_search_index(conn)
+        conn.execute(f'''
+            INSERT INTO items_fts (rowid, name, description)
+            SELECT id, {fts_normalize('name')}, {fts_normalize('description')} FROM items
+        ''')
+
+# Schema versions, stored in PRAGMA user_version: the database is at version N once the first N steps have run.
+# Append new steps at the end and never edit or reorder released ones. Steps check for existing tables only
+# because databases created before versioning start at 0 with part of the schema already in place. A step that
+# moves a lot of data may do it a chunk at a time: it returns False while work remains, gets called again in a
+# fresh transaction, and the version only moves on once it stops returning False.
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_order_items_table,
+    migrate_stats_tables,
+    create_images_table,
+    migrate_search_index,
+    create_cache_versions,
+    create_indexes,
+    migrate_idempotency_keys
+]
+
+# The archive is a separate file with its own user_version; it may be new even when menu.db is current.
+ARCHIVE_MIGRATIONS = [
+    create_archive_tables
+]
+
+def schema_version(conn, schema):
+    return conn.execute(f'PRAGMA {schema}.user_version').fetchone()[0]
+
+def apply_migrations(schema, migrations):
+    with db_connection() as conn:
+        version = schema_version(conn, schema)
+    if version > len(migrations):
+        raise RuntimeError(f'{schema} database schema version {version} is newer than this code '
+                           f'({len(migrations)})')
+    announced = None
+    while version < len(migrations):
+        with transaction() as conn:
+            # Another process may have migrated while this one waited for the write lock.
+            version = schema_version(conn, schema)
+            if version >= len(migrations):
+                break
+            if announced != version:
+                app.logger.info(f"Migrating {schema} database to schema version {version + 1}...")
+                announced = version
+            if migrations[version](conn) is False:
+                continue
+            version += 1
+            conn.execute(f'PRAGMA {schema}.user_version = {version}')
 
 def migrate_db():
-    if not os.path.exists(DB_NAME):
-        init_db()
-        return
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(orders)")
-        columns = [row[1] for row in cursor.fetchall()]
-        if 'created_at' not in columns:
-            app.logger.info("Migrating orders table: adding new columns...")
-            conn.execute('''
-                CREATE TABLE orders_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_name TEXT NOT NULL,
-                    phone TEXT NOT NULL,
-                    items TEXT NOT NULL,
-                    total INTEGER NOT NULL,
-                    status TEXT NOT NULL DEFAULT 'new',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    payment_method TEXT NOT NULL,
-                    payment_status TEXT NOT NULL,
-                    table_number TEXT NOT NULL,
-                    payment_comment TEXT
-                )
-            ''')
-            conn.execute('''
-                INSERT INTO orders_new (id, user_name, phone, items, total, status)
-                SELECT id, user_name, phone, items, total, status FROM orders
-            ''')
-            conn.execute('DROP TABLE orders')
-            conn.execute('ALTER TABLE orders_new RENAME TO orders')
-            conn.commit()
-            app.logger.info("Migration completed: new columns added.")
-        else:
-            if 'payment_method' not in columns:
-                conn.execute('ALTER TABLE orders ADD COLUMN payment_method TEXT')
-            if 'payment_status' not in columns:
-                conn.execute('ALTER TABLE orders ADD COLUMN payment_status TEXT')
-            if 'table_number' not in columns:
-                conn.execute('ALTER TABLE orders ADD COLUMN table_number TEXT')
-            if 'payment_comment' not in columns:
-                conn.execute('ALTER TABLE orders ADD COLUMN payment_comment TEXT')
-            conn.commit()
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='categories'")
-        if not cursor.fetchone():
-            app.logger.info("Creating categories table...")
-            conn.execute('''
-                CREATE TABLE categories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    value TEXT NOT NULL UNIQUE,
-                    name TEXT NOT NULL
-                )
-            ''')
-            categories = [
-                ('pizza', 'Пицца'),
-                ('pasta', 'Паста'),
-                ('drinks', 'Напитки'),
-                ('other', 'Другие')
-            ]
-            conn.executemany('INSERT INTO categories (value, name) VALUES (?, ?)', categories)
-            conn.commit()
+    # On a current database this is one PRAGMA read per attached file.
+    apply_migrations('archive', ARCHIVE_MIGRATIONS)
+    with db_connection() as conn:
+        current = schema_version(conn, 'main') == len(MIGRATIONS)
+    if not current:
+        rewrite_legacy_orders()
+        apply_migrations('main', MIGRATIONS)
+
+assets = {'files': None, 'signature': None}
+assets_lock = threading.Lock()
+
+def asset_sources():
+    sources = [page for page in ASSET_PAGES if os.path.isfile(os.path.join(FRONTEND_DIR, page))]
+    for root, _, names in os.walk(os.path.join(FRONTEND_DIR, ASSET_DIR)):
+        for name in names:
+            sources.append(os.path.relpath(os.path.join(root, name), FRONTEND_DIR).replace(os.sep, '/'))
+    return sorted(sources)
+
+def asset_signature(sources):
+    signature = []
+    for source in sources:
+        stat = os.stat(os.path.join(FRONTEND_DIR, source))
+        signature.append((source, stat.st_mtime_ns, stat.st_size))
+    return signature
+
+def write_file_atomic(path, data):
+    # Readers in other threads or workers see either the old file or the complete new one.
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_build_file(data):
+    # Build files are named by content, so concurrent builds from several workers never clash.
+    path = os.path.join(ASSET_BUILD_DIR, hashlib.sha256(data).hexdigest()[:32])
+    if not os.path.exists(path):
+        write_file_atomic(path, data)
+    return path
+
+def build_asset(data, mimetype, path=None):
+    entry = {
+        'path': path or write_build_file(data),
+        'mimetype': mimetype,
+        'etag': hashlib.sha256(data).hexdigest()[:32],
+        'immutable': False,
+        'encodings': {}
+    }
+    if mimetype.startswith(ASSET_COMPRESSIBLE):
+        compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(data)
+        for encoding, body in compressed.items():
+            if len(body) < len(data):
+                entry['encodings'][encoding] = write_build_file(body)
+    return entry
+
+def build_assets(sources):
+    # Files under src/ get a content-hashed URL that can be cached forever; pages keep their names and are
+    # rewritten to point at the hashed URLs. The plain src/ URLs stay valid (dish images in the menu use them).
+    os.makedirs(ASSET_BUILD_DIR, exist_ok=True)
+    files = {}
+    renamed = {}
+    for source in sources:
+        if source in ASSET_PAGES:
+            continue
+        path = os.path.join(FRONTEND_DIR, source)
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = build_asset(data, mimetypes.guess_type(source)[0] or 'application/octet-stream', path)
+        stem, ext = os.path.splitext(source)
+        hashed = f'{stem}.{entry["etag"][:12]}{ext}'
+        renamed[source] = hashed
+        files[source] = entry
+        files[hashed] = dict(entry, immutable=True)
+    pattern = None
+    if renamed:
+        pattern = re.compile(r'(?<![\w.-])(' + '|'.join(re.escape(source) for source in
+                                                       sorted(renamed, key=len, reverse=True)) + r')(?![\w.-])')
+    for source in sources:
+        if source not in ASSET_PAGES:
+            continue
+        with open(os.path.join(FRONTEND_DIR, source), encoding='utf-8') as f:
+            html = f.read()
+        if pattern:
+            html = pattern.sub(lambda match: renamed[match.group(1)], html)
+        files[source] = build_asset(html.encode('utf-8'), 'text/html')
+    return files
+
+def get_assets():
+    with assets_lock:
+        if assets['files'] is None or app.debug:
+            sources = asset_sources()
+            signature = asset_signature(sources)
+            if assets['signature'] != signature:
+                assets['files'] = build_assets(sources)
+                assets['signature'] = signature
+        return assets['files']
+
+def send_asset(name):
+    entry = get_assets().get(name)
+    if entry is None:
+        return jsonify({'error': 'Файл не найден'}), 404
+    encoding = next((encoding for encoding in ('br', 'gzip')
+                     if encoding in entry['encodings'] and request.accept_encodings[encoding]), None)
+    path = entry['encodings'][encoding] if encoding else entry['path']
+    # Each encoding is a different representation, so it needs its own strong validator.
+    etag = f"{entry['etag']}-{encoding}" if encoding else entry['etag']
+    response = send_file(path, mimetype=entry['mimetype'], etag=etag, conditional=True,
+                         max_age=ASSET_MAX_AGE if entry['immutable'] else None)
+    # Build files are named by hash; the URL already carries the real name.
+    response.headers.pop('Content-Disposition', None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if entry['encodings']:
+        response.vary.add('Accept-Encoding')
+    if entry['immutable']:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+menu_page = {'key': None, 'etag': None, 'bodies': None}
+menu_page_lock = threading.Lock()
+
+def render_menu_page(html, menu_body):
+    # "</" can't appear inside a script element; "<\/" is the same string to JSON.parse.
+    menu_json = menu_body.replace(b'</', b'<\\/')
+    return html.replace(MENU_DATA_PLACEHOLDER, MENU_DATA_PLACEHOLDER[:-9] + menu_json + b'</script>', 1)
+
+def get_menu_page():
+    # The guest menu page with the current menu embedded, so the first paint needs no /api/menu round trip.
+    # Rebuilt only when the page or the menu snapshot changes; returns (etag, {encoding: body}).
+    entry = get_assets()[MENU_PAGE]
+    _, menu_body, menu_etag = get_menu_snapshot()
+    key = (entry['etag'], menu_etag)
+    with menu_page_lock:
+        if menu_page['key'] == key:
+            return menu_page['etag'], menu_page['bodies']
+    with open(entry['path'], 'rb') as f:
+        body = render_menu_page(f.read(), menu_body)
+    bodies = {None: body, 'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    with menu_page_lock:
+        menu_page.update(key=key, etag=etag, bodies=bodies)
+    return etag, bodies
+
+def send_menu_page():
+    etag, bodies = get_menu_page()
+    encoding = next((encoding for encoding in ('br', 'gzip')
+                     if encoding in bodies and request.accept_encodings[encoding]), None)
+    etag = f'{etag}-{encoding}' if encoding else etag
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(bodies[encoding], mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    files = get_assets()
+    keep = {entry['path'] for entry in files.values()}
+    keep.update(path for entry in files.values() for path in entry['encodings'].values())
+    removed = 0
+    for name in os.listdir(ASSET_BUILD_DIR):
+        path = os.path.join(ASSET_BUILD_DIR, name)
+        if path not in keep:
+            os.remove(path)
+            removed += 1
+    print(f'{len(files)} assets built into {ASSET_BUILD_DIR}, {removed} stale files removed.')
 
 @app.route('/')
 def home():
-    return send_from_directory('static', 'login.html')
+    return send_asset('login.html')
+
+@app.route(f'/{MENU_PAGE}')
+def index_page():
+    return send_menu_page()
+
+@app.route('/<page>.html')
+def page(page):
+    return send_asset(f'{page}.html')
+
+@app.route(f'/{ASSET_DIR}/<path:filename>')
+def asset(filename):
+    return send_asset(f'{ASSET_DIR}/{filename}')
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -180,129 +1359,293 @@ def login():
     password = request.form.get('password')
     if not username or not password:
         return jsonify({'error': 'Заполните все поля'}), 400
-    user = next((u for u in users if u['username'] == username), None)
+    user = users.get(username)
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 401
-    if not bcrypt.checkpw(password.encode('utf-8'), user['password']):
+    retry_after = login_retry_after(username)
+    if retry_after:
+        response = jsonify({'error': 'Слишком много попыток входа, попробуйте позже'})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    try:
+        valid = check_password(password, user['password'])
+    except FutureTimeoutError:
+        valid = None
+    if valid is None:
+        response = jsonify({'error': 'Сервер перегружен, попробуйте позже'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    record_login_result(username, valid)
+    if not valid:
         return jsonify({'error': 'Неверный пароль'}), 401
     token = jwt.encode({'username': username}, SECRET_KEY, algorithm='HS256')
     return jsonify({'token': token})
 
 @app.route('/api/categories', methods=['GET'])
+@require_auth
 def get_categories():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
-    conn = get_db_connection()
-    categories = conn.execute('SELECT value, name FROM categories').fetchall()
-    conn.close()
+    with db_connection() as conn:
+        categories = conn.execute('SELECT value, name FROM categories').fetchall()
     return jsonify({'categories': [{'value': cat['value'], 'name': cat['name']} for cat in categories]})
 
 @app.route('/api/add-category', methods=['POST'])
+@require_auth
 def add_category():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     data = request.form
     value = data.get('value')
     name = data.get('name')
     if not all([value, name]):
         return jsonify({'error': 'Заполните все обязательные поля'}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute('INSERT INTO categories (value, name) VALUES (?, ?)', (value, name))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('INSERT INTO categories (value, name) VALUES (?, ?)', (value, name))
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Категория с таким значением уже существует'}), 400
-    finally:
-        conn.close()
+    invalidate_menu()
     return jsonify({'message': 'Категория успешно добавлена'})
 
 @app.route('/api/remove-category', methods=['POST'])
+@require_auth
 def remove_category():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     category_value = request.form.get('category-id')
     if not category_value:
         return jsonify({'error': 'Выберите категорию для удаления'}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM categories WHERE value = ?', (category_value,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Категория не найдена'}), 404
-    cursor.execute('DELETE FROM items WHERE category = ?', (category_value,))
-    cursor.execute('DELETE FROM categories WHERE value = ?', (category_value,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        if not conn.execute('SELECT value FROM categories WHERE value = ?', (category_value,)).fetchone():
+            return jsonify({'error': 'Категория не найдена'}), 404
+        conn.execute('DELETE FROM items WHERE category = ?', (category_value,))
+        conn.execute('DELETE FROM categories WHERE value = ?', (category_value,))
+    unindex_item_prices(category=category_value)
+    invalidate_menu()
     return jsonify({'message': 'Категория и связанные блюда успешно удалены'})
 
 @app.route('/api/menu', methods=['GET'])
+@admission_control()
 def get_menu():
-    conn = get_db_connection()
-    categories = conn.execute('SELECT value, name FROM categories').fetchall()
-    items = conn.execute('SELECT * FROM items').fetchall()
-    conn.close()
-    menu = {}
-    for cat in categories:
-        cat_value = cat['value']
-        menu[cat_value] = {'name': cat['name'], 'items': []}
-    for item in items:
-        cat = item['category']
-        if cat in menu:
-            menu[cat]['items'].append({
-                'id': item['id'],
-                'name': item['name'],
-                'description': item['description'],
-                'price': item['price'],
-                'image': item['image']
-            })
-    return jsonify({'categories': menu})
+    version, body, etag = get_menu_snapshot()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Menu-Version'] = str(version)
+    return response
+
+def image_srcset(image, variants):
+    if not image.startswith(IMAGE_URL_PREFIX):
+        return None
+    image_hash = image[len(IMAGE_URL_PREFIX):].split('.', 1)[0]
+    widths = variants.get(image_hash)
+    if not widths:
+        return None
+    return {
+        'webp': ', '.join(f'{IMAGE_URL_PREFIX}{image_hash}-{width}.webp {width}w' for width in widths.split(',')),
+        'jpeg': ', '.join(f'{IMAGE_URL_PREFIX}{image_hash}-{width}.jpg {width}w' for width in widths.split(','))
+    }
+
+def sniff_image_type(head):
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return None
+
+def store_image(stream):
+    # Returns (url, error, status). The upload is streamed to disk while hashing, so identical files share one copy.
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    tmp_path = os.path.join(IMAGE_DIR, f'upload.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(IMAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    return None, f'Изображение больше {IMAGE_MAX_BYTES // (1024 * 1024)} МБ', 413
+                if len(head) < 12:
+                    head = (head + chunk)[:12]
+                digest.update(chunk)
+                f.write(chunk)
+        ext = sniff_image_type(head)
+        if ext is None:
+            return None, 'Поддерживаются только JPEG, PNG, WebP и GIF', 400
+        image_hash = digest.hexdigest()[:32]
+        path = os.path.join(IMAGE_DIR, f'{image_hash}.{ext}')
+        if not os.path.exists(path):
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    with transaction() as conn:
+        conn.execute('INSERT OR IGNORE INTO images (hash, ext, size) VALUES (?, ?, ?)', (image_hash, ext, size))
+        pending = conn.execute('SELECT status FROM images WHERE hash = ?', (image_hash,)).fetchone()['status'] == 'pending'
+    if pending:
+        ensure_image_worker()
+        image_queue.put(image_hash)
+    return f'{IMAGE_URL_PREFIX}{image_hash}.{ext}', None, None
+
+def make_image_variants(image_hash, ext):
+    if Image is None:
+        return []
+    widths = []
+    with Image.open(os.path.join(IMAGE_DIR, f'{image_hash}.{ext}')) as original:
+        source = ImageOps.exif_transpose(original)
+        if source.mode != 'RGB':
+            # JPEG has no alpha channel, so transparent images are flattened onto white.
+            rgba = source.convert('RGBA')
+            source = Image.new('RGB', rgba.size, (255, 255, 255))
+            source.paste(rgba, mask=rgba)
+        for width in sorted({min(width, source.width) for width in IMAGE_VARIANT_WIDTHS}):
+            variant = source
+            if width < source.width:
+                variant = source.resize((width, max(1, round(source.height * width / source.width))), Image.LANCZOS)
+            for variant_ext, (image_format, options) in IMAGE_VARIANT_FORMATS.items():
+                buffer = io.BytesIO()
+                variant.save(buffer, image_format, **options)
+                write_file_atomic(os.path.join(IMAGE_DIR, f'{image_hash}-{width}.{variant_ext}'), buffer.getvalue())
+            widths.append(width)
+    return widths
+
+image_queue = queue.Queue()
+image_worker_state = {'thread': None}
+image_worker_lock = threading.Lock()
+
+def image_worker():
+    # Images left pending by an earlier process are picked up as well.
+    with db_connection() as conn:
+        for row in conn.execute("SELECT hash FROM images WHERE status = 'pending'").fetchall():
+            image_queue.put(row['hash'])
+    while True:
+        image_hash = image_queue.get()
+        with db_connection() as conn:
+            image = conn.execute("SELECT ext FROM images WHERE hash = ? AND status = 'pending'", (image_hash,)).fetchone()
+        if image is None:
+            continue
+        try:
+            widths = make_image_variants(image_hash, image['ext'])
+            status = 'ready' if widths else 'original'
+        except Exception as e:
+            app.logger.error(f"Image {image_hash} variants failed: {e}")
+            widths, status = [], 'failed'
+        with transaction() as conn:
+            conn.execute('UPDATE images SET status = ?, widths = ? WHERE hash = ?',
+                         (status, ','.join(str(width) for width in widths), image_hash))
+        if widths:
+            invalidate_menu()
+
+def ensure_image_worker():
+    with image_worker_lock:
+        if image_worker_state['thread'] is None:
+            image_worker_state['thread'] = threading.Thread(target=image_worker, name='image-worker', daemon=True)
+            image_worker_state['thread'].start()
+
+@app.route('/api/upload-image', methods=['POST'])
+@require_auth
+def upload_image():
+    # Accepts a multipart field 'image' or the raw file as the request body.
+    upload = request.files.get('image')
+    if upload is not None:
+        stream = upload.stream
+    elif request.mimetype.startswith('image/'):
+        stream = request.stream
+    else:
+        return jsonify({'error': 'Файл изображения не передан'}), 400
+    url, error, status = store_image(stream)
+    if error:
+        return jsonify({'error': error}), status
+    return jsonify({'message': 'Изображение загружено', 'image': url})
+
+@app.route(f'{IMAGE_URL_PREFIX}<path:filename>')
+def uploaded_image(filename):
+    # File names are content hashes, so they never change.
+    response = send_from_directory(IMAGE_DIR, filename, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def search_query(text):
+    # Every word must match as a prefix; quoting keeps FTS5 operators in user input from being parsed.
+    terms = re.findall(r'\w+', text.lower().replace('ё', 'е'))[:SEARCH_MAX_TERMS]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+@app.route('/api/menu/search', methods=['GET'])
+def search_menu():
+    query = search_query(request.args.get('q', ''))
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'Неверный параметр limit'}), 400
+    if not query:
+        return jsonify({'items': []})
+    with db_connection() as conn:
+        # Name matches rank above description matches.
+        rows = conn.execute('''
+            SELECT items.id, items.category, categories.name AS category_name, items.name, items.description,
+                   items.price, items.image
+            FROM items_fts
+            JOIN items ON items.id = items_fts.rowid
+            JOIN categories ON categories.value = items.category
+            WHERE items_fts MATCH ?
+            ORDER BY bm25(items_fts, 10.0, 1.0)
+            LIMIT ?
+        ''', (query, min(limit, SEARCH_MAX_LIMIT))).fetchall()
+        hashes = [row['image'][len(IMAGE_URL_PREFIX):].split('.', 1)[0] for row in rows
+                  if row['image'].startswith(IMAGE_URL_PREFIX)]
+        variants = {}
+        if hashes:
+            placeholders = ','.join('?' * len(hashes))
+            images = conn.execute(f"SELECT hash, widths FROM images WHERE status = 'ready' AND hash IN ({placeholders})",
+                                  hashes).fetchall()
+            variants = {image['hash']: image['widths'] for image in images}
+    return jsonify({'items': [{
+        'id': row['id'],
+        'category': row['category'],
+        'category_name': row['category_name'],
+        'name': row['name'],
+        'description': row['description'],
+        'price': row['price'],
+        'image': row['image'],
+        'srcset': image_srcset(row['image'], variants)
+    } for row in rows]})
 
 @app.route('/api/add-dish', methods=['POST'])
+@require_auth
 def add_dish():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     data = request.form
     name = data.get('name')
     category = data.get('category')
     description = data.get('description')
     price = data.get('price')
-    image = data.get('image') or 'src/images/default.jpg'
+    image = data.get('image') or DEFAULT_DISH_IMAGE
     if not all([name, category, description, price]):
         return jsonify({'error': 'Заполните все обязательные поля'}), 400
-    try:
-        price = int(price)
-        if price < 0:
-            raise ValueError
-    except ValueError:
+    price = parse_price(price)
+    if price is None:
         return jsonify({'error': 'Цена должна быть положительным числом'}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM categories WHERE value = ?', (category,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Категория не найдена'}), 404
-    cursor.execute('INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)',
-                   (category, name, description, price, image))
-    conn.commit()
-    conn.close()
+    upload = request.files.get('image_file')
+    if upload and upload.filename:
+        image, error, status = store_image(upload.stream)
+        if error:
+            return jsonify({'error': error}), status
+    with transaction() as conn:
+        if not conn.execute('SELECT value FROM categories WHERE value = ?', (category,)).fetchone():
+            return jsonify({'error': 'Категория не найдена'}), 404
+        cursor = conn.execute('INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)',
+                              (category, name, description, price, image))
+    index_item_price(cursor.lastrowid, name, price, category)
+    invalidate_menu()
     return jsonify({'message': 'Блюдо успешно добавлено'})
 
 @app.route('/api/remove-dish', methods=['POST'])
+@require_auth
 def remove_dish():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     dish_id = request.form.get('dish-id')
     if not dish_id:
         return jsonify({'error': 'Выберите блюдо для удаления'}), 400
@@ -310,147 +1653,897 @@ def remove_dish():
         dish_id = int(dish_id)
     except ValueError:
         return jsonify({'error': 'Неверный ID блюда'}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM items WHERE id = ?', (dish_id,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Блюдо не найдено'}), 404
-    cursor.execute('DELETE FROM items WHERE id = ?', (dish_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        if not conn.execute('SELECT id FROM items WHERE id = ?', (dish_id,)).fetchone():
+            return jsonify({'error': 'Блюдо не найдено'}), 404
+        conn.execute('DELETE FROM items WHERE id = ?', (dish_id,))
+    unindex_item_prices(item_id=dish_id)
+    invalidate_menu()
     return jsonify({'message': 'Блюдо успешно удалено'})
 
+def parse_price(value):
+    try:
+        price = int(value)
+    except (TypeError, ValueError):
+        return None
+    return price if price >= 0 else None
+
+MENU_BATCH_SQL = {
+    'add_category': ['INSERT INTO categories (value, name) VALUES (?, ?)'],
+    'remove_category': ['DELETE FROM items WHERE category = ?', 'DELETE FROM categories WHERE value = ?'],
+    'add_dish': ['INSERT INTO items (category, name, description, price, image) VALUES (?, ?, ?, ?, ?)'],
+    'remove_dish': ['DELETE FROM items WHERE id = ?']
+}
+
+def parse_menu_file(upload):
+    # A JSON file holds a list of operations (or {'operations': [...]}); a CSV file has one operation per row.
+    text = upload.read().decode('utf-8-sig')
+    if (upload.filename or '').lower().endswith('.csv'):
+        return [{key: value for key, value in row.items() if value not in (None, '')}
+                for row in csv.DictReader(io.StringIO(text))]
+    data = json.loads(text)
+    return data.get('operations') if isinstance(data, dict) else data
+
+def validate_menu_batch(conn, operations):
+    # Checks every operation against one snapshot of categories and dishes, replaying earlier operations of the batch.
+    categories = {row['value'] for row in conn.execute('SELECT value FROM categories')}
+    dish_ids = set()
+    for op in operations:
+        if isinstance(op, dict) and op.get('op') == 'remove_dish':
+            try:
+                dish_ids.add(int(op.get('id')))
+            except (TypeError, ValueError):
+                pass
+    dishes = {}
+    if dish_ids:
+        placeholders = ','.join('?' * len(dish_ids))
+        dishes = {row['id']: row['category'] for row in
+                  conn.execute(f'SELECT id, category FROM items WHERE id IN ({placeholders})', list(dish_ids))}
+    prepared = []
+    errors = []
+    for index, op in enumerate(operations):
+        kind = op.get('op') if isinstance(op, dict) else None
+        error = None
+        if kind == 'add_category':
+            value, name = op.get('value'), op.get('name')
+            if not all([value, name]):
+                error = 'Заполните все обязательные поля'
+            elif value in categories:
+                error = 'Категория с таким значением уже существует'
+            else:
+                categories.add(value)
+                prepared.append((kind, (value, name)))
+        elif kind == 'remove_category':
+            value = op.get('value')
+            if not value:
+                error = 'Выберите категорию для удаления'
+            elif value not in categories:
+                error = 'Категория не найдена'
+            else:
+                categories.discard(value)
+                dishes = {dish_id: category for dish_id, category in dishes.items() if category != value}
+                prepared.append((kind, (value,)))
+        elif kind == 'add_dish':
+            name, category, description = op.get('name'), op.get('category'), op.get('description')
+            price = parse_price(op.get('price'))
+            if not all([name, category, description]) or op.get('price') in (None, ''):
+                error = 'Заполните все обязательные поля'
+            elif price is None:
+                error = 'Цена должна быть положительным числом'
+            elif category not in categories:
+                error = 'Категория не найдена'
+            else:
+                prepared.append((kind, (category, name, description, price, op.get('image') or DEFAULT_DISH_IMAGE)))
+        elif kind == 'remove_dish':
+            try:
+                dish_id = int(op.get('id'))
+            except (TypeError, ValueError):
+                error = 'Неверный ID блюда'
+            else:
+                if dish_id not in dishes:
+                    error = 'Блюдо не найдено'
+                else:
+                    del dishes[dish_id]
+                    prepared.append((kind, (dish_id,)))
+        else:
+            error = 'Неизвестная операция'
+        if error:
+            errors.append({'index': index, 'error': error})
+    return prepared, errors
+
+@app.route('/api/menu/batch', methods=['POST'])
+@require_auth
+def menu_batch():
+    if 'file' in request.files:
+        try:
+            operations = parse_menu_file(request.files['file'])
+        except (ValueError, csv.Error):
+            return jsonify({'error': 'Не удалось прочитать файл'}), 400
+    else:
+        data = request.get_json(silent=True)
+        operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'Нет операций для применения'}), 400
+    if len(operations) > MENU_BATCH_MAX:
+        return jsonify({'error': f'Не больше {MENU_BATCH_MAX} операций за раз'}), 400
+    with transaction() as conn:
+        prepared, errors = validate_menu_batch(conn, operations)
+        if errors:
+            return jsonify({'error': 'Пакет отклонён, изменения не применены', 'errors': errors}), 400
+        for kind, params in prepared:
+            for sql in MENU_BATCH_SQL[kind]:
+                conn.execute(sql, params)
+    reset_price_index()
+    invalidate_menu()
+    return jsonify({'message': f'Применено операций: {len(prepared)}', 'applied': len(prepared)})
+
 @app.route('/api/generate-table-link', methods=['POST'])
+@require_auth
 def generate_table_link():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     location = request.form.get('location')
     if not location:
         return jsonify({'error': 'Укажите локацию'}), 400
-    table_token = jwt.encode({'location': location}, SECRET_KEY, algorithm='HS256')
-    link = f'file:///C:/Users/slava/Desktop/Defency/Some-site/redirect.html?lots={table_token}'
-    return jsonify({'link': link, 'table_number': location})
+    return jsonify({'link': make_table_link(location), 'table_number': location})
+
+def make_table_token(location):
+    return jwt.encode({'location': location}, SECRET_KEY, algorithm='HS256')
+
+def make_table_link(location):
+    return f'{TABLE_LINK_BASE}?lots={make_table_token(location)}'
+
+def excel_csv(header, rows):
+    # Yields the CSV text row by row. The BOM up front makes Excel open the Cyrillic text correctly.
+    output = io.StringIO()
+    writer = csv.writer(output)
+    yield '\ufeff'
+    for row in itertools.chain([header], rows):
+        writer.writerow(row)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+def table_links_csv(links):
+    return ''.join(excel_csv(['table_number', 'link'], ([link['table_number'], link['link']] for link in links)))
+
+def table_links_zip(links):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('links.csv', table_links_csv(links))
+        for link in links:
+            name = link['table_number'].replace('/', '_').replace('\\', '_')
+            archive.writestr(f'{name}.url', f"[InternetShortcut]\r\nURL={link['link']}\r\n")
+    return buffer.getvalue()
+
+@app.route('/api/generate-table-links', methods=['POST'])
+@require_auth
+def generate_table_links():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Укажите локации'}), 400
+    locations = data.get('locations')
+    if locations is None and 'from' in data and 'to' in data:
+        try:
+            start, end = int(data['from']), int(data['to'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Неверный диапазон'}), 400
+        if end < start:
+            return jsonify({'error': 'Неверный диапазон'}), 400
+        if end - start + 1 > TABLE_LINKS_MAX:
+            return jsonify({'error': f'Не больше {TABLE_LINKS_MAX} локаций за раз'}), 400
+        prefix = data.get('prefix', 'Столик')
+        locations = [f'{prefix} {number}'.strip() for number in range(start, end + 1)]
+    if not isinstance(locations, list) or not locations or not all(isinstance(location, str) and location for location in locations):
+        return jsonify({'error': 'Укажите локации'}), 400
+    if len(locations) > TABLE_LINKS_MAX:
+        return jsonify({'error': f'Не больше {TABLE_LINKS_MAX} локаций за раз'}), 400
+    links = [{'table_number': location, 'link': make_table_link(location)} for location in locations]
+    output_format = data.get('format') or request.args.get('format', 'json')
+    if output_format == 'csv':
+        return Response(table_links_csv(links), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=table-links.csv'})
+    if output_format == 'zip':
+        return Response(table_links_zip(links), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=table-links.zip'})
+    return jsonify({'links': links})
+
+def verify_table_token(table_token):
+    # Returns the table's location, or None for an invalid token.
+    if not isinstance(table_token, str):
+        return None
+    location = table_token_cache.get(table_token)
+    if location is not None:
+        return location
+    try:
+        data = jwt.decode(table_token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    location = data.get('location')
+    if location is not None:
+        table_token_cache.put(table_token, location)
+    return location
 
 @app.route('/api/verify-table', methods=['POST'])
+@admission_control()
 def verify_table():
     table_token = request.json.get('lots')
     if not table_token:
         return jsonify({'error': 'Локация отсутствует'}), 400
-    try:
-        data = jwt.decode(table_token, SECRET_KEY, algorithms=['HS256'])
-        return jsonify({'message': 'Токен валиден', 'table_number': data['location']})
-    except jwt.InvalidTokenError:
+    location = verify_table_token(table_token)
+    if location is None:
         return jsonify({'error': 'Неверная локация'}), 400
+    return jsonify({'message': 'Токен валиден', 'table_number': location})
+
+def cached_idempotent_order(key):
+    entry = idempotency_cache.get(key)
+    if entry is None:
+        return None
+    order_id, expires_at = entry
+    if expires_at <= time.time():
+        idempotency_cache.pop(key)
+        return None
+    return order_id
+
+def cache_idempotent_order(key, order_id):
+    idempotency_cache.put(key, (order_id, time.time() + IDEMPOTENCY_CACHE_TTL))
+
+def find_idempotent_order(conn, key):
+    row = conn.execute('SELECT id FROM orders WHERE idempotency_key = ?', (key,)).fetchone()
+    return row['id'] if row else None
+
+def insert_order(conn, order):
+    # A replayed key returns the order it created the first time. Inside the write transaction this check
+    # can't race with another insert of the same key.
+    key = order.get('idempotency_key')
+    if key is not None:
+        order_id = find_idempotent_order(conn, key)
+        if order_id is not None:
+            return order_id
+    cursor = conn.execute('''
+        INSERT INTO orders (user_name, phone, items, total, status, payment_method, payment_status, table_number,
+                            idempotency_key)
+        VALUES (?, ?, '', ?, 'new', ?, ?, ?, ?)
+    ''', (order['user_name'], order['phone'], order['total'], order['payment_method'],
+          order['payment_status'], order['table_number'], key))
+    order_id = cursor.lastrowid
+    conn.executemany('INSERT INTO order_items (order_id, item_id, name, unit_price, quantity) VALUES (?, ?, ?, ?, ?)',
+                     cart_to_order_items(order_id, order['lines']))
+    add_order_stats(conn, order_id)
+    record_order_change(conn, order_id)
+    return order_id
+
+order_ingest_queue = queue.Queue()
+order_writer_state = {'thread': None}
+order_writer_lock = threading.Lock()
+
+def write_orders_batch(batch):
+    results = []
+    with transaction() as conn:
+        for order, future in batch:
+            # A savepoint per order keeps one bad order from failing the whole batch.
+            conn.execute('SAVEPOINT order_insert')
+            try:
+                results.append(insert_order(conn, order))
+                conn.execute('RELEASE order_insert')
+            except sqlite3.Error as e:
+                conn.execute('ROLLBACK TO order_insert')
+                conn.execute('RELEASE order_insert')
+                results.append(e)
+    for (order, future), result in zip(batch, results):
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+    publish_order_changes()
+
+def order_writer():
+    while True:
+        batch = [order_ingest_queue.get()]
+        deadline = time.monotonic() + ORDER_BATCH_WINDOW
+        while len(batch) < ORDER_BATCH_SIZE:
+            try:
+                batch.append(order_ingest_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        # Orders whose request already timed out were cancelled; the guest was told to try again.
+        batch = [(order, future) for order, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        try:
+            write_orders_batch(batch)
+        except Exception as e:
+            app.logger.error(f"Order batch of {len(batch)} failed: {e}")
+            for order, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+def submit_order(order):
+    with order_writer_lock:
+        if order_writer_state['thread'] is None:
+            order_writer_state['thread'] = threading.Thread(target=order_writer, name='order-writer', daemon=True)
+            order_writer_state['thread'].start()
+    future = Future()
+    order_ingest_queue.put((order, future))
+    try:
+        return future.result(timeout=ORDER_INGEST_TIMEOUT)
+    except FutureTimeoutError:
+        # Take the order back out of the queue before answering 503. If the writer has already started on
+        # it, it will be committed, so wait for that instead of inviting a duplicate retry.
+        if future.cancel():
+            raise
+        return future.result()
+
+def order_created_response(order_id, replayed=False):
+    response = jsonify({'message': 'Заказ успешно создан', 'order_id': order_id})
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
 
 @app.route('/api/create-order', methods=['POST'])
+@admission_control(order_slots)
 def create_order():
+    # Clients send the same Idempotency-Key when retrying, so a lost response never creates a second order.
+    key = request.headers.get('Idempotency-Key') or None
+    if key is not None:
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'error': 'Неверный ключ идемпотентности'}), 400
+        order_id = cached_idempotent_order(key)
+        if order_id is None:
+            with db_connection() as conn:
+                order_id = find_idempotent_order(conn, key)
+        if order_id is not None:
+            cache_idempotent_order(key, order_id)
+            return order_created_response(order_id, replayed=True)
+
     data = request.json
     user_name = data.get('user_name')
     phone = data.get('phone')
     cart = data.get('cart')
     payment_method = data.get('payment_method')
-    table_number = data.get('table_number')
+    table_token = data.get('lots')
 
-    if not all([user_name, phone, cart, payment_method, table_number]):
+    if not all([user_name, phone, cart, payment_method, table_token]):
         return jsonify({'error': 'Заполните все поля'}), 400
+    # The table comes from the signed link the guest scanned, never from what the client says it is.
+    table_number = verify_table_token(table_token)
+    if table_number is None:
+        return jsonify({'error': 'Неверная локация'}), 400
 
     payment_status = 'Оплачен' if payment_method in ['click', 'payme'] else 'Не оплачен'
 
     try:
-        total = sum(item['price'] * item['quantity'] for item in cart)
-    except Exception as e:
+        lines, total, missing = quote_cart(cart)
+    except (KeyError, TypeError, ValueError) as e:
         app.logger.error(f"Invalid cart format: {e}")
         return jsonify({'error': 'Неверный формат корзины'}), 400
+    if missing:
+        return jsonify({'error': 'Некоторые блюда больше недоступны', 'missing': missing}), 400
 
-    items_json = json.dumps(cart)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO orders (user_name, phone, items, total, status, payment_method, payment_status, table_number)
-        VALUES (?, ?, ?, ?, 'new', ?, ?, ?)
-    ''', (user_name, phone, items_json, total, payment_method, payment_status, table_number))
-    conn.commit()
-    order_id = cursor.lastrowid
-    conn.close()
-    return jsonify({'message': 'Заказ успешно создан', 'order_id': order_id})
+    # Charged only for orders that would otherwise go through, so junk requests can't lock a table out.
+    retry_after = table_order_limiter.take(table_token)
+    if retry_after:
+        return reject_request('table_rate', 429, retry_after)
+
+    order = {
+        'user_name': user_name,
+        'phone': phone,
+        'total': total,
+        'payment_method': payment_method,
+        'payment_status': payment_status,
+        'table_number': table_number,
+        'lines': lines,
+        'idempotency_key': key
+    }
+    if ORDER_INGEST_MODE == 'batch':
+        try:
+            order_id = submit_order(order)
+        except FutureTimeoutError:
+            return jsonify({'error': 'Сервер перегружен, попробуйте ещё раз'}), 503
+    else:
+        with transaction() as conn:
+            order_id = insert_order(conn, order)
+        publish_order_changes()
+    if key is not None:
+        cache_idempotent_order(key, order_id)
+    return order_created_response(order_id)
+
+@app.route('/api/cart/quote', methods=['POST'])
+def cart_quote():
+    data = request.json or {}
+    try:
+        lines, total, missing = quote_cart(data.get('cart'))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Неверный формат корзины'}), 400
+    return jsonify({'items': lines, 'total': total, 'missing': missing})
+
+def encode_orders_cursor(created_at, order_id):
+    raw = f'{created_at}|{order_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_orders_cursor(cursor):
+    try:
+        created_at, order_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return created_at, int(order_id)
+    except (ValueError, UnicodeError):
+        return None
+
+def add_date_filters(args, column, where, params):
+    date_from = args.get('date_from')
+    if date_from:
+        where.append(f'{column} >= ?')
+        params.append(date_from)
+    date_to = args.get('date_to')
+    if date_to:
+        # A bare date means the whole day is included.
+        if len(date_to) == 10:
+            date_to += ' 23:59:59'
+        where.append(f'{column} <= ?')
+        params.append(date_to)
+
+def order_to_dict(order):
+    return {
+        'id': order['id'],
+        'user_name': order['user_name'],
+        'phone': order['phone'],
+        'items': [],
+        'total': order['total'],
+        'status': order['status'],
+        'timestamp': order['created_at'],
+        'payment_method': order['payment_method'],
+        'payment_status': order['payment_status'],
+        'table_number': order['table_number'],
+        'payment_comment': order['payment_comment']
+    }
+
+def fetch_orders(conn, query, params, schema='main'):
+    # query selects whole orders rows; line items are joined on and folded into each order in one pass.
+    rows = conn.execute(f'''
+        SELECT o.*, oi.id AS line_id, oi.item_id, oi.name AS item_name, oi.unit_price, oi.quantity
+        FROM ({query}) o
+        LEFT JOIN {schema}.order_items oi ON oi.order_id = o.id
+        ORDER BY o.created_at DESC, o.id DESC, oi.id
+    ''', params)
+    orders = []
+    for row in rows:
+        if not orders or orders[-1]['id'] != row['id']:
+            orders.append(order_to_dict(row))
+        if row['line_id'] is not None:
+            orders[-1]['items'].append({
+                'id': row['item_id'],
+                'name': row['item_name'],
+                'price': row['unit_price'],
+                'quantity': row['quantity']
+            })
+    return orders
+
+def order_filters(args):
+    where = []
+    params = []
+    for field in ('status', 'payment_status', 'table_number'):
+        value = args.get(field)
+        if value:
+            where.append(f'{field} = ?')
+            params.append(value)
+    add_date_filters(args, 'created_at', where, params)
+    return where, params
+
+def order_schemas(conn, args):
+    # Only hot orders are read unless the date filter reaches back past what has been archived.
+    row = conn.execute("SELECT value FROM archive.archive_state WHERE key = 'archived_before'").fetchone()
+    date_from = args.get('date_from')
+    if row is None or not (date_from or args.get('date_to')) or args.get('status', 'closed') != 'closed':
+        return ['main']
+    if date_from and date_from >= row['value']:
+        return ['main']
+    return ['main', 'archive']
 
 @app.route('/api/orders', methods=['GET'])
+@require_auth
 def get_orders():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders ORDER BY created_at DESC').fetchall()
-    conn.close()
-    orders_list = []
+    args = request.args
+    try:
+        limit = int(args.get('limit', ORDERS_PAGE_SIZE))
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Неверный размер страницы'}), 400
+    limit = min(limit, ORDERS_MAX_PAGE_SIZE)
+    where, params = order_filters(args)
+    cursor_value = args.get('cursor')
+    if cursor_value:
+        position = decode_orders_cursor(cursor_value)
+        if not position:
+            return jsonify({'error': 'Неверный курсор'}), 400
+        where.append('(created_at, id) < (?, ?)')
+        params.extend(position)
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    params.append(limit + 1)
+    with db_connection() as conn:
+        feed_cursor = get_feed_cursor(conn)
+        schemas = order_schemas(conn, args)
+        orders = []
+        for schema in schemas:
+            query = f'SELECT * FROM {schema}.orders{where_sql} ORDER BY created_at DESC, id DESC LIMIT ?'
+            orders.extend(fetch_orders(conn, query, params, schema))
+    if len(schemas) > 1:
+        # An order caught mid-archival can briefly exist in both; the hot copy comes first and wins.
+        seen = set()
+        orders = [order for order in orders if order['id'] not in seen and not seen.add(order['id'])]
+        orders.sort(key=lambda order: (order['timestamp'], order['id']), reverse=True)
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        last = orders[-1]
+        next_cursor = encode_orders_cursor(last['timestamp'], last['id'])
+    return jsonify({
+        'orders': orders,
+        'next_cursor': next_cursor,
+        'feed_cursor': feed_cursor
+    })
+
+def iter_export_orders(schema, where, params):
+    # Keyset-paged reads on a short-lived pooled connection per chunk, so a slow download neither pins a
+    # connection nor holds a read transaction open that would keep WAL checkpoints from finishing.
+    position = None
+    while True:
+        conditions = list(where)
+        chunk_params = list(params)
+        if position:
+            conditions.append('(created_at, id) > (?, ?)')
+            chunk_params.extend(position)
+        where_sql = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        chunk_params.append(ORDER_EXPORT_CHUNK)
+        with db_connection() as conn:
+            orders = fetch_orders(conn, f'SELECT * FROM {schema}.orders{where_sql} ORDER BY created_at, id LIMIT ?',
+                                  chunk_params, schema)
+        # fetch_orders returns newest first.
+        orders.reverse()
+        yield from orders
+        if len(orders) < ORDER_EXPORT_CHUNK:
+            return
+        position = (orders[-1]['timestamp'], orders[-1]['id'])
+
+def unique_orders(orders):
+    # An order caught mid-archival can come from both databases; after the merge the copies are adjacent.
+    last_id = None
+    for order in orders:
+        if order['id'] != last_id:
+            yield order
+        last_id = order['id']
+
+def ndjson_lines(orders):
+    for order in orders:
+        yield json.dumps(order, ensure_ascii=False) + '\n'
+
+def order_csv_rows(orders):
     for order in orders:
-        orders_list.append({
-            'id': order['id'],
-            'user_name': order['user_name'],
-            'phone': order['phone'],
-            'items': json.loads(order['items']),
-            'total': order['total'],
-            'status': order['status'],
-            'timestamp': order['created_at'],
-            'payment_method': order['payment_method'],
-            'payment_status': order['payment_status'],
-            'table_number': order['table_number'],
-            'payment_comment': order['payment_comment']
-        })
-    return jsonify({'orders': orders_list})
+        # One row per line item, so the file sums up in a spreadsheet without unpacking anything.
+        for item in order['items'] or [None]:
+            yield [
+                order['id'], order['timestamp'], order['table_number'], order['user_name'], order['phone'],
+                order['status'], order['payment_method'], order['payment_status'], order['payment_comment'],
+                order['total'],
+                item['id'] if item else '', item['name'] if item else '',
+                item['price'] if item else '', item['quantity'] if item else ''
+            ]
+
+def csv_lines(orders):
+    return excel_csv(ORDER_EXPORT_CSV_COLUMNS, order_csv_rows(orders))
+
+def buffered_chunks(pieces):
+    # Groups small pieces into ~64 KB writes instead of one chunk per row.
+    buffer = []
+    size = 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= ORDER_EXPORT_FLUSH_BYTES:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+@app.route('/api/orders/export', methods=['GET'])
+@require_auth
+def export_orders():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Формат должен быть ndjson или csv'}), 400
+    where, params = order_filters(request.args)
+    with db_connection() as conn:
+        schemas = order_schemas(conn, request.args)
+    orders = unique_orders(heapq.merge(*(iter_export_orders(schema, where, params) for schema in schemas),
+                                       key=lambda order: (order['timestamp'], order['id'])))
+    lines = ndjson_lines(orders) if export_format == 'ndjson' else csv_lines(orders)
+    filename = f'orders-{datetime.date.today().isoformat()}.{export_format}'
+    # No Content-Length, so the body goes out with chunked transfer encoding as it is produced.
+    return Response(buffered_chunks(lines),
+                    mimetype='application/x-ndjson' if export_format == 'ndjson' else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def read_order_changes(conn, since):
+    changes = conn.execute('SELECT seq, order_id FROM order_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                           (since, ORDER_FEED_BATCH)).fetchall()
+    if not changes:
+        return since, []
+    order_ids = list({change['order_id'] for change in changes})
+    placeholders = ','.join('?' * len(order_ids))
+    orders = fetch_orders(conn, f'SELECT * FROM orders WHERE id IN ({placeholders})', order_ids)
+    return changes[-1]['seq'], orders
+
+@app.route('/api/orders/changes', methods=['GET'])
+@require_auth
+def get_order_changes():
+    try:
+        since = int(request.args.get('cursor', ''))
+    except ValueError:
+        return jsonify({'error': 'Неверный курсор'}), 400
+    try:
+        timeout = float(request.args.get('timeout', ORDER_FEED_TIMEOUT))
+    except ValueError:
+        return jsonify({'error': 'Неверный таймаут'}), 400
+    # nan would slip past every comparison below and turn the long poll into a busy loop.
+    if not math.isfinite(timeout) or timeout < 0:
+        return jsonify({'error': 'Неверный таймаут'}), 400
+    timeout = min(timeout, ORDER_FEED_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    with db_connection() as conn:
+        oldest, latest = conn.execute('SELECT MIN(seq), MAX(seq) FROM order_changes').fetchone()
+    # The cursor is older than the retained log or from another database: the client must reload.
+    if since > (latest or 0) or (oldest is not None and since < oldest - 1):
+        return jsonify({'orders': [], 'cursor': latest or 0, 'reset': True})
+    while True:
+        # The pooled connection is only held for the check, not for the whole wait.
+        with db_connection() as conn:
+            cursor, orders = read_order_changes(conn, since)
+        remaining = deadline - time.monotonic()
+        if orders or remaining <= 0:
+            break
+        # Re-check at least once a second so writes from other processes are picked up too.
+        with order_feed:
+            order_feed.wait(min(remaining, 1.0))
+    return jsonify({'orders': orders, 'cursor': cursor, 'reset': False})
+
+@app.route('/api/dish-sales', methods=['GET'])
+@require_auth
+def get_dish_sales():
+    where = []
+    params = []
+    add_date_filters(request.args, 'o.created_at', where, params)
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    dishes = {}
+    with db_connection() as conn:
+        for schema in order_schemas(conn, request.args):
+            rows = conn.execute(f'''
+                SELECT oi.item_id, oi.name, SUM(oi.quantity) AS quantity, SUM(oi.unit_price * oi.quantity) AS revenue
+                FROM {schema}.order_items oi
+                JOIN {schema}.orders o ON o.id = oi.order_id{where_sql}
+                GROUP BY oi.item_id, oi.name
+            ''', params).fetchall()
+            for row in rows:
+                dish = dishes.setdefault((row['item_id'], row['name']), {
+                    'id': row['item_id'], 'name': row['name'], 'quantity': 0, 'revenue': 0
+                })
+                dish['quantity'] += row['quantity']
+                dish['revenue'] += row['revenue']
+    return jsonify({'dishes': sorted(dishes.values(), key=lambda dish: dish['revenue'], reverse=True)})
+
+@app.route('/api/stats', methods=['GET'])
+@require_auth
+def get_stats():
+    where = []
+    params = []
+    if request.args.get('date_from'):
+        where.append('day >= date(?)')
+        params.append(request.args['date_from'])
+    if request.args.get('date_to'):
+        where.append('day <= date(?)')
+        params.append(request.args['date_to'])
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    with db_connection() as conn:
+        days = conn.execute(f'SELECT * FROM sales_daily{where_sql} ORDER BY day', params).fetchall()
+        tables = conn.execute(f'''
+            SELECT table_number, SUM(orders) AS orders, SUM(revenue) AS revenue
+            FROM sales_by_table{where_sql} GROUP BY table_number ORDER BY revenue DESC
+        ''', params).fetchall()
+        payments = conn.execute(f'''
+            SELECT payment_method, payment_status, SUM(orders) AS orders, SUM(revenue) AS revenue
+            FROM sales_by_payment{where_sql} GROUP BY payment_method, payment_status HAVING SUM(orders) != 0
+            ORDER BY revenue DESC
+        ''', params).fetchall()
+        dishes = conn.execute(f'''
+            SELECT item_id, name, SUM(quantity) AS quantity, SUM(revenue) AS revenue
+            FROM sales_by_dish{where_sql} GROUP BY item_id, name ORDER BY revenue DESC
+        ''', params).fetchall()
+    return jsonify({
+        'days': [dict(row) for row in days],
+        'tables': [dict(row) for row in tables],
+        'payments': [dict(row) for row in payments],
+        'dishes': [{'id': row['item_id'] or None, 'name': row['name'], 'quantity': row['quantity'],
+                    'revenue': row['revenue']} for row in dishes],
+        'totals': {
+            'orders': sum(row['orders'] for row in days),
+            'revenue': sum(row['revenue'] for row in days),
+            'closed_orders': sum(row['closed_orders'] for row in days)
+        }
+    })
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    migrate_db()
+    with transaction() as conn:
+        rebuild_stats(conn)
+    print('Sales summary tables rebuilt.')
+
+def purge_archived_orders(conn, cutoff, ids=None):
+    # Drops hot rows whose archive copy still matches in every field that can change after closing.
+    query = '''
+        SELECT o.id FROM main.orders o JOIN archive.orders a ON a.id = o.id
+        WHERE o.status = 'closed' AND o.created_at < ?
+          AND a.status IS o.status AND a.payment_status IS o.payment_status AND a.payment_comment IS o.payment_comment
+    '''
+    params = [cutoff]
+    if ids is not None:
+        query += f" AND o.id IN ({','.join('?' * len(ids))})"
+        params.extend(ids)
+    purged = [row['id'] for row in conn.execute(query, params).fetchall()]
+    if purged:
+        placeholders = ','.join('?' * len(purged))
+        conn.execute(f'DELETE FROM main.order_items WHERE order_id IN ({placeholders})', purged)
+        conn.execute(f'DELETE FROM main.orders WHERE id IN ({placeholders})', purged)
+    return len(purged)
+
+def archive_orders(days=ORDER_ARCHIVE_AFTER_DAYS):
+    # Copying and deleting are separate transactions: commits spanning attached WAL databases are only atomic
+    # per file, so an interrupted run may leave an order in both places (purged next run) but never in neither.
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    moved = 0
+    with transaction() as conn:
+        moved += purge_archived_orders(conn, cutoff)
+    while True:
+        with transaction() as conn:
+            ids = [row['id'] for row in conn.execute('''
+                SELECT id FROM main.orders WHERE status = 'closed' AND created_at < ? ORDER BY created_at, id LIMIT ?
+            ''', (cutoff, ORDER_ARCHIVE_BATCH)).fetchall()]
+            if not ids:
+                break
+            placeholders = ','.join('?' * len(ids))
+            conn.execute(f'''
+                INSERT OR REPLACE INTO archive.orders ({ORDER_COLUMNS})
+                SELECT {ORDER_COLUMNS} FROM main.orders WHERE id IN ({placeholders})
+            ''', ids)
+            conn.execute(f'DELETE FROM archive.order_items WHERE order_id IN ({placeholders})', ids)
+            conn.execute(f'''
+                INSERT INTO archive.order_items ({ORDER_ITEM_COLUMNS})
+                SELECT {ORDER_ITEM_COLUMNS} FROM main.order_items WHERE order_id IN ({placeholders})
+            ''', ids)
+        # Orders updated in between keep their hot row and are copied again on the next pass.
+        with transaction() as conn:
+            moved += purge_archived_orders(conn, cutoff, ids)
+    with transaction() as conn:
+        conn.execute('''
+            INSERT INTO archive.archive_state (key, value) VALUES ('archived_before', ?)
+            ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)
+        ''', (cutoff,))
+    return moved
+
+def claim_archive_run():
+    # Every worker process runs the archiver thread; the timestamp in archive_state lets one of them do the work.
+    with transaction() as conn:
+        row = conn.execute("SELECT value FROM archive.archive_state WHERE key = 'last_run'").fetchone()
+        now = time.time()
+        if row and now - float(row['value']) < ORDER_ARCHIVE_INTERVAL:
+            return False
+        conn.execute("INSERT OR REPLACE INTO archive.archive_state (key, value) VALUES ('last_run', ?)", (str(now),))
+    return True
+
+order_archiver_state = {'thread': None}
+order_archiver_lock = threading.Lock()
+
+def order_archiver():
+    while True:
+        time.sleep(ORDER_ARCHIVE_CHECK_INTERVAL)
+        try:
+            if claim_archive_run():
+                moved = archive_orders()
+                if moved:
+                    app.logger.info(f"Archived {moved} closed orders.")
+        except sqlite3.Error as e:
+            app.logger.error(f"Order archival failed: {e}")
+
+def start_order_archiver():
+    if ORDER_ARCHIVE_AFTER_DAYS <= 0:
+        return
+    with order_archiver_lock:
+        if order_archiver_state['thread'] is None:
+            order_archiver_state['thread'] = threading.Thread(target=order_archiver, name='order-archiver', daemon=True)
+            order_archiver_state['thread'].start()
+
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=ORDER_ARCHIVE_AFTER_DAYS, help='Archive closed orders older than this.')
+def archive_orders_command(days):
+    migrate_db()
+    print(f'{archive_orders(days)} closed orders moved to {archive_db_name()}.')
+
+# action: (new status, which orders may make the move)
+ORDER_TRANSITIONS = {
+    'take': ('in_progress', "status = 'new'"),
+    'close': ('closed', "status != 'closed'")
+}
+
+def transition_orders(conn, action, order_ids):
+    # One conditional UPDATE moves every order that is in a valid state. Returns {order_id: 'ok' | 'invalid' |
+    # 'not_found'}; telling invalid from missing takes a lookup, but only for the orders that didn't move.
+    status, condition = ORDER_TRANSITIONS[action]
+    order_ids = list(dict.fromkeys(order_ids))
+    placeholders = ', '.join('?' * len(order_ids))
+    moved = [row['id'] for row in conn.execute(f'''
+        UPDATE orders SET status = ? WHERE id IN ({placeholders}) AND {condition} RETURNING id
+    ''', (status, *order_ids)).fetchall()]
+    for order_id in moved:
+        if action == 'close':
+            record_order_closed_stats(conn, order_id)
+        record_order_change(conn, order_id)
+    results = dict.fromkeys(moved, 'ok')
+    failed = [order_id for order_id in order_ids if order_id not in results]
+    if failed:
+        existing = {row['id'] for row in conn.execute(
+            f"SELECT id FROM orders WHERE id IN ({', '.join('?' * len(failed))})", failed)}
+        for order_id in failed:
+            results[order_id] = 'invalid' if order_id in existing else 'not_found'
+    return {order_id: results[order_id] for order_id in order_ids}
+
+def transition_order_response(order_id, action, message, invalid_error):
+    with transaction() as conn:
+        result = transition_orders(conn, action, [order_id])[order_id]
+    if result == 'not_found':
+        return jsonify({'error': 'Заказ не найден'}), 404
+    if result == 'invalid':
+        return jsonify({'error': invalid_error}), 400
+    publish_order_changes()
+    return jsonify({'message': message})
 
 @app.route('/api/take-order/<int:order_id>', methods=['POST'])
+@require_auth
 def take_order(order_id):
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT status FROM orders WHERE id = ?', (order_id,))
-    result = cursor.fetchone()
-    if not result:
-        conn.close()
-        return jsonify({'error': 'Заказ не найден'}), 404
-    if result['status'] != 'new':
-        conn.close()
-        return jsonify({'error': 'Заказ уже взят или закрыт'}), 400
-    cursor.execute('UPDATE orders SET status = "in_progress" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({'message': 'Заказ взят в работу'})
+    return transition_order_response(order_id, 'take', 'Заказ взят в работу', 'Заказ уже взят или закрыт')
 
 @app.route('/api/close-order/<int:order_id>', methods=['POST'])
+@require_auth
 def close_order(order_id):
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT status FROM orders WHERE id = ?', (order_id,))
-    result = cursor.fetchone()
-    if not result:
-        conn.close()
-        return jsonify({'error': 'Заказ не найден'}), 404
-    if result['status'] == 'closed':
-        conn.close()
-        return jsonify({'error': 'Заказ уже закрыт'}), 400
-    cursor.execute('UPDATE orders SET status = "closed" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({'message': 'Заказ закрыт'})
+    return transition_order_response(order_id, 'close', 'Заказ закрыт', 'Заказ уже закрыт')
+
+@app.route('/api/orders/transitions', methods=['POST'])
+@require_auth
+def bulk_transition_orders():
+    # {"take": [ids], "close": [ids]} in one transaction; takes run first, so an id may appear in both.
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Неверный список заказов'}), 400
+    actions = {action: data.get(action) or [] for action in ORDER_TRANSITIONS}
+    if not all(isinstance(ids, list) and all(type(order_id) is int for order_id in ids) for ids in actions.values()):
+        return jsonify({'error': 'Неверный список заказов'}), 400
+    total = sum(len(ids) for ids in actions.values())
+    if not total:
+        return jsonify({'error': 'Укажите заказы'}), 400
+    if total > ORDER_BULK_MAX:
+        return jsonify({'error': f'Не больше {ORDER_BULK_MAX} заказов за раз'}), 400
+    results = []
+    with transaction() as conn:
+        for action, ids in actions.items():
+            if ids:
+                outcome = transition_orders(conn, action, ids)
+                results.extend({'order_id': order_id, 'action': action, 'result': result}
+                               for order_id, result in outcome.items())
+    updated = sum(result['result'] == 'ok' for result in results)
+    if updated:
+        publish_order_changes()
+    return jsonify({'results': results, 'updated': updated, 'failed': len(results) - updated})
 
 @app.route('/api/update-payment-status/<int:order_id>', methods=['POST'])
+@require_auth
 def update_payment_status(order_id):
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    username, error, status = verify_token(token)
-    if error:
-        return jsonify(error), status
     data = request.json
     payment_status = data.get('payment_status')
     payment_comment = data.get('payment_comment', '')
@@ -460,29 +2553,62 @@ def update_payment_status(order_id):
         return jsonify({'error': 'Неверный статус оплаты'}), 400
     if payment_status == 'Оплата при выезде' and not payment_comment:
         return jsonify({'error': 'Комментарий обязателен для статуса "Оплата при выезде"'}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM orders WHERE id = ?', (order_id,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Заказ не найден'}), 404
-    cursor.execute('UPDATE orders SET payment_status = ?, payment_comment = ? WHERE id = ?',
-                   (payment_status, payment_comment, order_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        # Take the order's old payment status out of the summary first; for a missing order it matches no row.
+        add_order_stats(conn, order_id, -1, ['sales_by_payment'])
+        cursor = conn.execute('UPDATE orders SET payment_status = ?, payment_comment = ? WHERE id = ?',
+                              (payment_status, payment_comment, order_id))
+        if not cursor.rowcount:
+            return jsonify({'error': 'Заказ не найден'}), 404
+        add_order_stats(conn, order_id, 1, ['sales_by_payment'])
+        record_order_change(conn, order_id)
+    publish_order_changes()
     return jsonify({'message': 'Статус оплаты обновлен'})
 
 @app.route('/logout')
 def logout():
     return jsonify({'message': 'Logged out'})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def metrics_endpoint():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+def record_request_metrics(status):
+    if g.get('metrics_started') is None:
+        return
+    elapsed = time.perf_counter() - g.pop('metrics_started')
+    endpoint = metrics_endpoint()
+    http_requests_total.inc(request.method, endpoint, status)
+    http_request_seconds.observe(elapsed, request.method, endpoint)
+    http_request_db_statements.observe(db_stats.statements, endpoint)
+    http_request_db_seconds.observe(db_stats.seconds, endpoint)
+
+@app.before_request
+def start_request_metrics():
+    db_stats.statements = 0
+    db_stats.seconds = 0.0
+    g.metrics_started = time.perf_counter()
+
+@app.teardown_request
+def finish_request_metrics(error):
+    # Requests that raised never reach after_request.
+    record_request_metrics(500)
+
 @app.after_request
 def after_request(response):
+    record_request_metrics(response.status_code)
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Idempotency-Key')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
     return response
 
 if __name__ == '__main__':
+    # Development server; run serve.py in production.
     migrate_db()
     app.run(port=3000, debug=True)
\ No newline at end of file
@@ -0,0 +1,127 @@
+# Production entry point: a master process owns the listening socket and keeps --workers worker processes
+# running, each a threaded WSGI server over the shared menu.db.
+# Usage: python back/serve.py --port 3000 --workers 4
+# SIGHUP starts a fresh set of workers (picking up new code) and drains the old ones; SIGTERM/SIGINT drain and exit.
+# On Windows, which can't hand the socket to child processes, a single threaded worker runs in-process.
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+GRACEFUL_TIMEOUT = 30
+MASTER_POLL_INTERVAL = 0.5
+LISTEN_BACKLOG = 1024
+
+def run_worker(fd, host, port):
+    import main
+    main.start_cache_watcher()
+    main.start_order_archiver()
+    active = {'requests': 0}
+    idle = threading.Condition()
+
+    def finished():
+        with idle:
+            active['requests'] -= 1
+            idle.notify_all()
+
+    def tracked_app(environ, start_response):
+        with idle:
+            active['requests'] += 1
+        try:
+            return ClosingIterator(main.app(environ, start_response), finished)
+        except BaseException:
+            finished()
+            raise
+
+    server = make_server(host, port, tracked_app, threaded=True, fd=fd)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on the thread serving.
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if fd is not None:
+        # Ctrl+C reaches the whole process group; the master decides when workers stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    # Let requests in flight finish; idle keep-alive connections are just dropped.
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    with idle:
+        while active['requests'] and time.monotonic() < deadline:
+            idle.wait(deadline - time.monotonic())
+    main.close_db_pool()
+
+def run_master(host, port, workers):
+    import main
+    # Migrations run once here rather than racing in every worker.
+    main.migrate_db()
+    main.close_db_pool()
+    sock = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    signals = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    def spawn():
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker-fd', str(sock.fileno()),
+                                 '--host', host, '--port', str(port)], pass_fds=(sock.fileno(),))
+
+    current = [spawn() for _ in range(workers)]
+    draining = []
+    print(f'Serving on http://{host}:{port} with {workers} workers (master pid {os.getpid()})', flush=True)
+    while True:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP:
+                print('Restarting workers', flush=True)
+                for process in current:
+                    process.terminate()
+                draining.extend(current)
+                current = [spawn() for _ in range(workers)]
+            else:
+                for process in current + draining:
+                    process.terminate()
+                deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+                for process in current + draining:
+                    try:
+                        process.wait(max(deadline - time.monotonic(), 0))
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                sock.close()
+                return
+        draining = [process for process in draining if process.poll() is None]
+        for index, process in enumerate(current):
+            if process.poll() is not None:
+                print(f'Worker {process.pid} exited with {process.returncode}, restarting', flush=True)
+                current[index] = spawn()
+        time.sleep(MASTER_POLL_INTERVAL)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_fd is not None:
+        run_worker(args.worker_fd, args.host, args.port)
+    elif os.name == 'nt':
+        import main
+        main.migrate_db()
+        run_worker(None, args.host, args.port)
+    else:
+        run_master(args.host, args.port, max(1, args.workers))
+
+if __name__ == '__main__':
+    run()
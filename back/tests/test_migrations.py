@@ -0,0 +1,71 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+GOOD = json.dumps([{'id': 1, 'name': 'Маргарита', 'price': 550, 'quantity': 2}])
+NULL_PRICE = json.dumps([{'id': 2, 'name': 'Морс', 'price': None, 'quantity': 1}])
+NOT_A_DICT = json.dumps([{'id': 1, 'name': 'Маргарита', 'price': 550, 'quantity': 1}, 'Пепперони'])
+UNREADABLE = '{not json'
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    # An orders table from before order_items, as the first versions of the app created it.
+    path = str(tmp_path / 'menu.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            items TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'new',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            payment_method TEXT,
+            payment_status TEXT,
+            table_number TEXT,
+            payment_comment TEXT
+        )
+    ''')
+    # Several unreadable blobs in a row fill whole chunks on their own.
+    blobs = [GOOD, UNREADABLE, UNREADABLE, UNREADABLE, NULL_PRICE, NOT_A_DICT, '[]', GOOD]
+    conn.executemany("INSERT INTO orders (user_name, phone, items, total) VALUES ('Гость', '+998', ?, 100)",
+                     [(blob,) for blob in blobs])
+    conn.commit()
+    conn.close()
+    main.close_db_pool()
+    monkeypatch.setattr(main, 'DB_NAME', path)
+    monkeypatch.setattr(main, 'MIGRATION_COPY_BATCH', 2)
+    yield path
+    main.close_db_pool()
+
+def test_legacy_order_items_migration_keeps_bad_blobs(legacy_db):
+    main.migrate_db()
+
+    conn = sqlite3.connect(legacy_db)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(main.MIGRATIONS)
+    items = dict(conn.execute('SELECT id, items FROM orders'))
+    assert items == {1: '', 2: UNREADABLE, 3: UNREADABLE, 4: UNREADABLE, 5: '', 6: NOT_A_DICT, 7: '', 8: ''}
+    lines = conn.execute('SELECT order_id, item_id, name, unit_price, quantity FROM order_items ORDER BY id').fetchall()
+    assert lines == [
+        (1, 1, 'Маргарита', 550, 2),
+        (5, 2, 'Морс', 0, 1),
+        (6, 1, 'Маргарита', 550, 1),
+        (8, 1, 'Маргарита', 550, 2)
+    ]
+    assert conn.execute('SELECT COUNT(*) FROM migration_state').fetchone()[0] == 0
+    conn.close()
+
+def test_migrate_db_is_a_no_op_once_current(legacy_db):
+    main.migrate_db()
+    conn = sqlite3.connect(legacy_db)
+    before = conn.execute('SELECT COUNT(*) FROM order_items').fetchone()[0]
+    main.migrate_db()
+    assert conn.execute('SELECT COUNT(*) FROM order_items').fetchone()[0] == before
+    conn.close()